@@ -0,0 +1,319 @@
+"""Measure the throughput of each conversion stage on synthetic documents.
+
+Corpora are generated with PyMuPDF (so no TeX install is needed) in every
+combination of the chosen page counts, column counts, with or without
+images, Latin or CJK text and horizontal or vertical writing; they're kept
+in --corpus-dir and reused by later runs. Each corpus is converted in a
+fresh interpreter, running every stage in isolation on the materialized
+output of the previous one, and pages/s, lines/s, peak RSS and output size
+are reported per stage as JSON. With --baseline, results are compared to a
+previous run saved with --save, and the exit status is 1 if any stage got
+slower by more than --tolerance."""
+
+from typing import Any, Callable, Iterator
+from dataclasses import dataclass
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from instrument import rss
+import baseline
+
+module_dir_ = os.path.dirname(os.path.abspath(__file__))
+
+LATIN_TEXT = ('The quick brown fox jumps over the lazy dog while the conver- '
+              'sation about informa- tion retrieval continues. Meanwhile, '
+              'several columns of text flow around the occasional figure.')
+CJK_TEXT = ('天地玄黄，宇宙洪荒。日月盈昃，辰宿列张。寒来暑往，秋收冬藏。'
+            '闰余成岁，律吕调阳。云腾致雨，露结为霜。金生丽水，玉出昆冈。')
+# Distinct pages generated per corpus; longer corpora repeat them
+TEMPLATE_PAGES = 8
+
+
+@dataclass
+class Corpus:
+    pages: int
+    columns: int
+    images: bool
+    script: str  # 'latin' or 'cjk'
+    direction: str  # 'horizontal' or 'vertical'
+
+    @property
+    def name(self) -> str:
+        return 'p%d-c%d-%s-%s-%s' % (self.pages, self.columns,
+                                     'img' if self.images else 'noimg',
+                                     self.script, self.direction[0])
+
+
+def make_template_page(doc: 'fitz.Document', corpus: Corpus,
+                       number: int) -> None:
+    """Add a page of the corpus: a heading on the first page, an image at the
+    top if wanted and the rest filled with text in columns (horizontal) or
+    in bands of right-to-left columns of characters (vertical)."""
+
+    import fitz
+
+    page = doc.new_page()
+    font = fitz.Font('cjk' if corpus.script == 'cjk' else 'helv')
+    text = CJK_TEXT if corpus.script == 'cjk' else LATIN_TEXT
+    writer = fitz.TextWriter(page.rect)
+    size = 10
+    top = 72
+    if number == 0:
+        writer.append((72, top), 'Chapter', font=font, fontsize=18)
+        top += 30
+    if corpus.images:
+        pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 64, 64), False)
+        pix.set_rect(pix.irect, (200, 30 * number % 256, 30))
+        page.insert_image(fitz.Rect(72, top, 136, top + 64),
+                          stream=pix.tobytes('png'))
+        top += 80
+    width = page.rect.width - 144
+    bottom = page.rect.height - 72
+    offset = number * 17
+    if corpus.direction == 'horizontal':
+        col_width = width / corpus.columns
+        # Approximate number of characters fitting in a column
+        n_chars = int(col_width / (size if corpus.script == 'cjk'
+                                   else size * 0.5))
+        for col in range(corpus.columns):
+            for y in range(int(top), int(bottom), 14):
+                start = (offset + y) % len(text)
+                line = (text * 2)[start:start + n_chars]
+                writer.append((72 + col * col_width, y), line,
+                              font=font, fontsize=size)
+    else:
+        band_height = (bottom - top) / corpus.columns
+        n_chars = int(band_height / size) - 1
+        for band in range(corpus.columns):
+            y0 = top + band * band_height + size
+            for x in range(int(72 + width), 72, -16):
+                start = (offset + x) % len(text)
+                for i, char in enumerate((text * 2)[start:start + n_chars]):
+                    writer.append((x, y0 + i * size), char,
+                                  font=font, fontsize=size)
+    writer.write_text(page)
+
+
+def make_corpus(corpus: Corpus, path: str) -> None:
+    """Generate a corpus file, repeating a few template pages and adding a
+    chapter to the table of contents at every repetition."""
+
+    import fitz
+
+    template = fitz.open()
+    n_template = min(TEMPLATE_PAGES, corpus.pages)
+    for number in range(n_template):
+        make_template_page(template, corpus, number)
+    # Embedding only the glyphs used keeps CJK corpora small
+    template.subset_fonts()
+    doc = fitz.open()
+    toc = []
+    while doc.page_count < corpus.pages:
+        toc.append([1, 'Chapter %d' % (len(toc) + 1,), doc.page_count + 1])
+        n = min(n_template, corpus.pages - doc.page_count)
+        doc.insert_pdf(template, to_page=n - 1)
+    doc.set_toc(toc)
+    doc.set_metadata({'title': corpus.name})
+    tmp = path + '.tmp'
+    doc.save(tmp, garbage=1, deflate=True)
+    os.replace(tmp, path)
+
+
+class PeakRss:
+    """Track the peak resident set size while the context is active by
+    sampling it in a background thread."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self) -> None:
+        while True:
+            self.peak = max(self.peak, rss())
+            if self.done.wait(self.interval):
+                break
+
+    def __enter__(self) -> 'PeakRss':
+        self.peak = rss()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.done.set()
+        self.thread.join()
+        self.peak = max(self.peak, rss())
+
+
+def lines_size(lines: list) -> int:
+    """Bytes of text and images in a list of lines."""
+
+    from line import LineType
+
+    size = 0
+    for line in lines:
+        if line.type == LineType.TEXT:
+            size += sum(len(span.text.encode()) for span in line.spans)
+        else:
+            size += len(line.image)
+    return size
+
+
+def run_stage(name: str, fn: Callable[[], Any], pages: int, n_in: int,
+              size: Callable[[Any], int]) -> tuple[dict[str, Any], Any]:
+    """Run a stage, returning its measurements and its output. The
+    throughput in lines counts the stage's input (or output, for
+    extraction)."""
+
+    with PeakRss() as peak:
+        start, cpu_start = time.perf_counter(), time.process_time()
+        out = fn()
+        seconds = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+    n_lines = n_in if n_in > 0 else len(out)
+    seconds = max(seconds, 1e-9)
+    return {
+        'stage': name,
+        'seconds': round(seconds, 4),
+        'cpu_seconds': round(cpu, 4),
+        'pages_per_s': round(pages / seconds, 1),
+        'lines_per_s': round(n_lines / seconds, 1),
+        'peak_rss_mb': round(peak.peak / (1 << 20), 1),
+        'output_bytes': size(out)
+    }, out
+
+
+def bench_pdf(src: str, vertical: bool, jobs: int) -> list[dict[str, Any]]:
+    """Run every stage in isolation on a PDF file."""
+
+    import main
+    import epubgen
+    from document import Session
+    from line import LineType
+
+    opt = main.ConvertOptions(vertical=vertical, jobs=jobs)
+    results = []
+    with Session(src) as session, tempfile.TemporaryDirectory() as tmp:
+        pages = session.page_count
+        title = main.extract_title(session)
+        toc = main.extract_toc(session)
+        # Like a conversion, run the statistics pre-pass first, as a stage
+        # of its own on the pages it samples
+        resolved = []
+
+        def analyze() -> list:
+            resolved.append(main.resolve_options(opt, session))
+            return [line for lines in session.sampled_lines.values()
+                    for line in lines]
+
+        result, _ = run_stage('analyze_document', analyze, pages, 0,
+                              lines_size)
+        n_sampled = session.statistics.pages_sampled
+        result['pages_per_s'] = round(n_sampled / result['seconds'], 1)
+        results.append(result)
+        opt = resolved[0]
+        # Extraction would take the sampled pages from the pre-pass, and
+        # look faster than it is
+        session.sampled_lines.clear()
+        data = session
+        n_in = 0
+        for name, step in [('extract_rawlines', main.extract_rawlines),
+                           ('splice_rawlines', main.splice_rawlines),
+                           ('reformat_rawlines', main.reformat_rawlines),
+                           ('aggregate_lines', main.aggregate_lines)]:
+            result, data = run_stage(
+                name, lambda: list(step(opt)(data)), pages, n_in, lines_size)
+            results.append(result)
+            n_in = len(data)
+
+        # Render paragraphs for the single-chapter writer outside the timer
+        html = ''.join('<p>%s</p>' % (epubgen.escape(
+            ''.join(span.text for span in line.spans)),)
+                       for line in data if line.type == LineType.TEXT)
+        result, _ = run_stage(
+            'to_epub',
+            lambda: main.to_epub(opt)(title, toc, iter(data),
+                                      os.path.join(tmp, 'to_epub.epub')),
+            pages, n_in, os.path.getsize)
+        results.append(result)
+        result, _ = run_stage(
+            'create_epub',
+            lambda: epubgen.create_epub(epubgen.EpubData(title, html),
+                                        os.path.join(tmp, 'create.epub')),
+            pages, n_in, os.path.getsize)
+        results.append(result)
+    return results
+
+
+def corpora(args: argparse.Namespace) -> Iterator[Corpus]:
+    for pages, columns, images, script, direction in itertools.product(
+            args.pages, args.columns, args.images, args.script,
+            args.direction):
+        yield Corpus(pages, columns, images == 'yes', script, direction)
+
+
+def benchmark(args: argparse.Namespace) -> dict[str, Any]:
+    os.makedirs(args.corpus_dir, exist_ok=True)
+    runs = []
+    for corpus in corpora(args):
+        path = os.path.join(args.corpus_dir, corpus.name + '.pdf')
+        if not os.path.exists(path):
+            make_corpus(corpus, path)
+        cmd = [sys.executable, os.path.abspath(__file__), '--pdf', path,
+               '--jobs', str(args.jobs)]
+        if corpus.direction == 'vertical':
+            cmd.append('--vertical')
+        # A fresh interpreter per corpus keeps peak RSS comparable
+        proc = subprocess.run(cmd, cwd=module_dir_, capture_output=True,
+                              text=True, check=True)
+        # The result is the last line; libraries may print warnings before
+        runs.append({'corpus': corpus.name,
+                     'stages': json.loads(proc.stdout.splitlines()[-1])})
+    return {'python': sys.version.split()[0], 'jobs': args.jobs,
+            'runs': runs}
+
+
+def measure(result: dict[str, Any]) -> dict[str, float]:
+    """Throughput of each stage on each corpus."""
+
+    return {'%s %s' % (run['corpus'], stage['stage']): stage['pages_per_s']
+            for run in result['runs'] for stage in run['stages']}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, nargs='+',
+                        default=[10, 100, 1000, 5000])
+    parser.add_argument('--columns', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--images', nargs='+', choices=['no', 'yes'],
+                        default=['no', 'yes'])
+    parser.add_argument('--script', nargs='+', choices=['latin', 'cjk'],
+                        default=['latin', 'cjk'])
+    parser.add_argument('--direction', nargs='+',
+                        choices=['horizontal', 'vertical'],
+                        default=['horizontal', 'vertical'])
+    parser.add_argument('--corpus-dir', type=str,
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'pdf2epub-corpus'),
+                        help='where generated corpora are kept')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of processes used to extract pages')
+    parser.add_argument('--pdf', type=str,
+                        help='only benchmark this PDF file')
+    parser.add_argument('--vertical', action='store_true',
+                        help='convert --pdf as vertically typesetted')
+    baseline.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.pdf is not None:
+        print(json.dumps(bench_pdf(args.pdf, args.vertical, args.jobs)))
+        sys.exit(0)
+    baseline.report(args, benchmark(args), measure, 'pages/s')
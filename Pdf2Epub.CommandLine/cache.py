@@ -0,0 +1,271 @@
+from typing import Any, BinaryIO, Callable, Iterator
+from contextlib import contextmanager
+import hashlib
+import json
+import marshal
+import os
+import shutil
+import tempfile
+
+from line import Line, LineType, Span, TextLine, ImageLine, intern_style
+
+
+def file_digest(src: str) -> str:
+    """SHA-256 of a file's contents, as a hex string."""
+
+    h = hashlib.sha256()
+    with open(src, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@contextmanager
+def atomic_file(path: str) -> Iterator[BinaryIO]:
+    """Write a file through a temporary file renamed into place once the
+    context exits, so that concurrent readers never see a partial file."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    with atomic_file(path) as f:
+        f.write(data)
+
+
+class ResultCache:
+    """A content-addressed cache of finished ePub files on local disk.
+
+    Results are keyed on the PDF bytes, the conversion options and the
+    pipeline version, and stored as `<root>/<key[:2]>/<key>.epub`. Entries
+    are written to a temporary file and renamed into place, so concurrent
+    processes on a host can share a cache directory; when the cache grows
+    beyond `max_bytes`, the least recently used entries are removed."""
+
+    def __init__(self, root: str, max_bytes: int, version: str,
+                 ignored_options: tuple[str, ...] = ()):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.version = version
+        # Options that don't affect the result, e.g. degree of parallelism
+        self.ignored_options = ignored_options
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, options: dict[str, Any], src: str) -> str:
+        """Hash a PDF file together with conversion options."""
+
+        options = {k: v for k, v in options.items()
+                   if k not in self.ignored_options}
+        data = json.dumps([self.version, file_digest(src), options],
+                          sort_keys=True)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key + '.epub')
+
+    def get(self, key: str, dest: str | None = None) -> str | None:
+        """Copy a cached result to `dest` (or to a new temporary path if not
+        given) and return its path, or None on a miss."""
+
+        path = self.path(key)
+        try:
+            cached = open(path, 'rb')
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        # Only create the destination on a hit; the entry stays readable
+        # while it's open, even if it's evicted meanwhile
+        with cached:
+            if dest is None:
+                fd, dest = tempfile.mkstemp(suffix='.epub')
+                out = os.fdopen(fd, 'wb')
+            else:
+                out = open(dest, 'wb')
+            with out:
+                shutil.copyfileobj(cached, out)
+        try:
+            # The modification time orders entries for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return dest
+
+    def put(self, key: str, src: str) -> None:
+        """Store a result, then evict entries if the cache is over size."""
+
+        with open(src, 'rb') as f, atomic_file(self.path(key)) as out:
+            shutil.copyfileobj(f, out)
+        self.evict()
+
+    def entries(self) -> list[tuple[float, int, str]]:
+        """(mtime, size, path) of every entry, least recently used first."""
+
+        entries = []
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if not entry.name.endswith('.epub'):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        entries.sort()
+        return entries
+
+    def evict(self) -> None:
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self) -> dict[str, int]:
+        entries = self.entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries)
+        }
+
+
+# Version of the page cache format; change it whenever the format or the
+# extraction it stores changes, so that stale entries are never read
+PAGE_FORMAT = 1
+
+
+def pack_lines(lines: list[Line]) -> bytes:
+    """Serialize the raw lines of a page as nested tuples with `marshal`."""
+
+    records = []
+    for line in lines:
+        if line.type == LineType.TEXT:
+            records.append((LineType.TEXT.value, line.bbox,
+                            tuple((s.text, s.bbox, s.style)
+                                  for s in line.spans)))
+        else:
+            # Lazily read images are stored as their xref
+            xref = getattr(line.data, 'xref', None)
+            records.append((LineType.IMAGE.value, line.bbox, line.ext,
+                            line.width, line.height,
+                            line.image if xref is None else xref))
+    return marshal.dumps(tuple(records))
+
+
+def unpack_lines(data: bytes, page: int,
+                 resolve: Callable[[int], Any] | None = None) -> list[Line]:
+    """Deserialize the lines of a page; `resolve` turns the xref of a
+    lazily read image back into a reference to it."""
+
+    lines = []
+    for record in marshal.loads(data):
+        if record[0] == LineType.TEXT.value:
+            _, bbox, spans = record
+            lines.append(TextLine([Span(text, span_bbox, intern_style(style))
+                                   for text, span_bbox, style in spans],
+                                  bbox, page))
+        else:
+            _, bbox, ext, width, height, image = record
+            if isinstance(image, int):
+                image = resolve(image)
+            lines.append(ImageLine(bbox, page, ext, width, height, image))
+    return lines
+
+
+class PageCache:
+    """A cache of the raw lines extracted from each page of a document.
+
+    Pages are stored as `<root>/v<format>/<digest>/<page>.bin`, where
+    `digest` is the hash of the PDF file, so re-converting a document with
+    other options needs no page to be parsed again. Like `ResultCache`, it
+    is safe to share among processes; when it grows beyond `max_bytes`,
+    whole documents are removed (by `evict`), least recently used first."""
+
+    def __init__(self, root: str, digest: str, max_bytes: int,
+                 resolve: Callable[[int], Any] | None = None):
+        self.root = os.path.join(root, 'v%d' % (PAGE_FORMAT,))
+        self.dir = os.path.join(self.root, digest)
+        self.max_bytes = max_bytes
+        # Turns xrefs of lazily read images back into references
+        self.resolve = resolve
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.dir, exist_ok=True)
+        # The modification time orders documents for eviction
+        os.utime(self.dir)
+
+    def path(self, page: int) -> str:
+        return os.path.join(self.dir, '%d.bin' % (page,))
+
+    def get(self, page: int) -> list[Line] | None:
+        """The lines of a page, or None on a miss."""
+
+        try:
+            with open(self.path(page), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return unpack_lines(data, page, self.resolve)
+
+    def put(self, page: int, lines: list[Line]) -> None:
+        try:
+            write_atomic(self.path(page), pack_lines(lines))
+        except FileNotFoundError:
+            # The document was evicted by another process meanwhile
+            pass
+
+    def evict(self) -> None:
+        """Remove documents until the cache fits in `max_bytes`. The
+        current document goes last, and only as many of its pages as needed
+        are removed, oldest first."""
+
+        documents = []
+        for entry in os.scandir(self.root):
+            if not entry.is_dir():
+                continue
+            try:
+                pages = [(page.stat().st_mtime, page.stat().st_size,
+                          page.path) for page in os.scandir(entry.path)]
+                documents.append((entry.path == self.dir,
+                                  entry.stat().st_mtime, entry.path, pages))
+            except FileNotFoundError:
+                continue
+        documents.sort()
+        total = sum(size for *_, pages in documents for _, size, _ in pages)
+        for current, _, path, pages in documents:
+            if total <= self.max_bytes:
+                break
+            if not current:
+                shutil.rmtree(path, ignore_errors=True)
+                total -= sum(size for _, size, _ in pages)
+                continue
+            for _, size, page in sorted(pages):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(page)
+                except FileNotFoundError:
+                    pass
+                total -= size
@@ -0,0 +1,192 @@
+from typing import Any, Callable, Iterable, Iterator
+from dataclasses import dataclass, field, asdict
+from contextlib import contextmanager
+import json
+import os
+import sys
+import threading
+import time
+
+
+def rss() -> int:
+    """Resident set size of this process, in bytes."""
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+
+        # Peak rather than current size where /proc isn't available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@dataclass
+class StageStats:
+    name: str
+    # Time spent in the stage itself, not in the stages feeding it
+    seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    # None for a stage whose input isn't a stream
+    items_in: int | None = None
+    items_out: int | None = None
+    # Peak resident set size sampled while the stage was running, in bytes
+    peak_rss: int = 0
+
+
+@dataclass
+class PipelineStats:
+    """Timing and item counts of each stage of a conversion, plus counters
+    of interesting quantities (merged spans, images, bytes written...).
+
+    Stages are chained generators, so a stage only runs while the next one
+    pulls from it. `run` and `call` meter those pulls and subtract the time
+    spent pulling from the stage before, without materializing anything."""
+
+    stages: list[StageStats] = field(default_factory=list)
+    counters: dict[str, int] = field(default_factory=dict)
+    # The stage running right now, which memory samples are attributed to
+    active: StageStats | None = None
+    # Statistics of the converted document, from its sampling pre-pass
+    document: dict[str, Any] | None = None
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def inputs(self, stage: StageStats, items: Iterable,
+               on_item: Callable[[Any], None] | None) -> Iterator:
+        """Count items flowing into a stage, deducting the time taken to
+        produce them from the stage."""
+
+        stage.items_in = 0
+        it = iter(items)
+        while True:
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                stage.seconds -= time.perf_counter() - wall
+                stage.cpu_seconds -= time.process_time() - cpu
+            stage.items_in += 1
+            if on_item is not None:
+                on_item(item)
+            yield item
+
+    def run(self, name: str, step: Callable[[Any], Iterable], data: Any,
+            on_input: Callable[[Any], None] | None = None,
+            on_output: Callable[[Any], None] | None = None) -> Iterator:
+        """Apply a streaming stage to `data` (an iterable, or the document
+        for the first stage), metering it as its output is consumed."""
+
+        stage = StageStats(name=name, items_out=0)
+        self.stages.append(stage)
+        if isinstance(data, Iterator):
+            data = self.inputs(stage, data, on_input)
+        wall, cpu = time.perf_counter(), time.process_time()
+        it = iter(step(data))
+        stage.seconds += time.perf_counter() - wall
+        stage.cpu_seconds += time.process_time() - cpu
+        return self.outputs(stage, it, on_output)
+
+    def outputs(self, stage: StageStats, it: Iterator,
+                on_item: Callable[[Any], None] | None) -> Iterator:
+        """Count items flowing out of a stage, adding the time taken to
+        produce them to the stage."""
+
+        while True:
+            outer, self.active = self.active, stage
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                stage.seconds += time.perf_counter() - wall
+                stage.cpu_seconds += time.process_time() - cpu
+                self.active = outer
+            stage.items_out += 1
+            if on_item is not None:
+                on_item(item)
+            yield item
+
+    def call(self, name: str, fn: Callable[[Iterator], Any], data: Iterable,
+             on_input: Callable[[Any], None] | None = None) -> Any:
+        """Call a stage that consumes a stream rather than producing one,
+        e.g. one that writes the result."""
+
+        with self.measure(name) as stage:
+            return fn(self.inputs(stage, data, on_input))
+
+    @contextmanager
+    def measure(self, name: str) -> Iterator[StageStats]:
+        """Meter the code run in the context as a stage, e.g. a pre-pass
+        that isn't part of the stream."""
+
+        stage = StageStats(name=name)
+        self.stages.append(stage)
+        outer, self.active = self.active, stage
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield stage
+        finally:
+            stage.seconds += time.perf_counter() - wall
+            stage.cpu_seconds += time.process_time() - cpu
+            self.active = outer
+
+    @contextmanager
+    def sample_memory(self, interval: float = 0.01) -> Iterator[None]:
+        """Sample the resident set size in a background thread while the
+        context is active, keeping the peak of each stage.
+
+        RSS rather than `tracemalloc` is sampled, since most of the memory
+        is allocated by MuPDF, out of `tracemalloc`'s sight."""
+
+        done = threading.Event()
+
+        def sample() -> None:
+            while not done.wait(interval):
+                stage = self.active
+                if stage is not None:
+                    stage.peak_rss = max(stage.peak_rss, rss())
+
+        thread = threading.Thread(target=sample, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            done.set()
+            thread.join()
+
+    def as_dict(self) -> dict[str, Any]:
+        stages = []
+        for stage in self.stages:
+            stage = asdict(stage)
+            stage['seconds'] = round(stage['seconds'], 4)
+            stage['cpu_seconds'] = round(stage['cpu_seconds'], 4)
+            stage['peak_rss_mb'] = round(stage.pop('peak_rss') / (1 << 20), 1)
+            stages.append(stage)
+        record = {'stages': stages, 'counters': dict(self.counters)}
+        if self.document is not None:
+            record['document'] = self.document
+        return record
+
+
+def log_stats(path: str, record: dict[str, Any]) -> None:
+    """Append a record as one line of JSON to a file, or to stderr if the
+    path is '-'.
+
+    Each record is a single write to a file opened for appending, so
+    concurrent workers can log to the same file."""
+
+    line = json.dumps(record, ensure_ascii=False) + '\n'
+    if path == '-':
+        sys.stderr.write(line)
+        sys.stderr.flush()
+        return
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
@@ -0,0 +1,118 @@
+import mmap
+import os
+
+module_dir_ = os.path.dirname(os.path.abspath(__file__))
+WORDS_SRC = os.path.join(module_dir_, 'words.xz')
+WORDS_LEX = os.path.join(module_dir_, 'words.lex')
+
+
+def build(src: str = WORDS_SRC, dest: str = WORDS_LEX) -> None:
+    """Build a lexicon file from a pickled, xz-compressed set of words.
+
+    The file is just the words in byte order, one per line, so that it can
+    be memory-mapped and binary searched in place. It's written to a
+    temporary file first and renamed, so concurrent builders and readers
+    never see a partial file."""
+
+    import lzma
+    import pickle
+
+    with lzma.open(src, 'rb') as f:
+        words = pickle.load(f)
+    data = b''.join(w + b'\n' for w in sorted(w.encode() for w in words))
+    tmp = '%s.%d.tmp' % (dest, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, dest)
+
+
+class Lexicon:
+    """A read-only set of words backed by a memory-mapped lexicon file.
+
+    The file is mapped on the first lookup, and built first if it doesn't
+    exist. All processes on a host share the mapped pages."""
+
+    def __init__(self, path: str = WORDS_LEX, src: str = WORDS_SRC):
+        self.path = path
+        self.src = src
+        self.data = None
+
+    def load(self) -> mmap.mmap:
+        if self.data is None:
+            if not os.path.exists(self.path):
+                build(self.src, self.path)
+            with open(self.path, 'rb') as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.data
+
+    def __contains__(self, word: str) -> bool:
+        data = self.load()
+        key = word.encode()
+        lo, hi = 0, len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind(b'\n', 0, mid) + 1
+            end = data.find(b'\n', start)
+            w = data[start:end]
+            if w == key:
+                return True
+            if w < key:
+                lo = end + 1
+            else:
+                hi = start
+        return False
+
+
+# Inflections recognized by replacing every occurrence of a suffix with the
+# ending of the stem (anywhere in the word, as `str.replace` does)
+INFLECTIONS = (('ing', 'e'), ('ion', 'e'), ('ied', 'y'), ('ies', 'y'))
+# Number of extra letters at the end of a word that are allowed
+MAX_EXTRA_LETTERS = 3
+
+
+class WordLookup:
+    """Whether strings are English words, allowing for up to three extra
+    letters (plurals, past tenses...) and for the inflections in
+    `INFLECTIONS`.
+
+    Each word costs up to eight binary searches of the lexicon, and the
+    fragments joined across line breaks recur all over a book, so the last
+    `memo_size` answers are memoized, least recently used out first."""
+
+    def __init__(self, lexicon: Lexicon, memo_size: int = 4096):
+        self.lexicon = lexicon
+        self.memo_size = memo_size
+        self.memo = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, word: str) -> bool:
+        lexicon = self.lexicon
+        if word in lexicon:
+            return True
+        for k in range(1, min(len(word), MAX_EXTRA_LETTERS + 1)):
+            if word[:-k] in lexicon:
+                return True
+        # Words without a suffix are unchanged by replacing it, and were
+        # looked up already
+        return any(suffix in word and word.replace(suffix, stem) in lexicon
+                   for suffix, stem in INFLECTIONS)
+
+    def __contains__(self, word: str) -> bool:
+        memo = self.memo
+        found = memo.pop(word, None)
+        if found is None:
+            self.misses += 1
+            found = self.lookup(word)
+            if len(memo) >= self.memo_size > 0:
+                memo.pop(next(iter(memo)))
+        else:
+            self.hits += 1
+        if self.memo_size > 0:
+            # Reinserting moves the word to the most recent end
+            memo[word] = found
+        return found
+
+
+if __name__ == '__main__':
+    build()
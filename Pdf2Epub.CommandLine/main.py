@@ -1,19 +1,26 @@
 from typing import Any, Callable, Generic, Iterable, Iterator, Literal, TypeVar
-from dataclasses import dataclass
-import numpy as np
-import unicodedata
-import html
-import math
-import base64
-import lzma
-import pickle
-
-import fitz
-
-from line import Line, LineType, make_line, line_type
+from dataclasses import dataclass, field, asdict, replace
+from contextlib import nullcontext
+import os
+
+from line import Line, LineType, Span, ImageLine, clear_styles, intern_style, \
+    make_line, line_type
+from document import LazyImage, Session
+from docstats import DocumentStats, analyze, sample_pages
+from lexicon import Lexicon, WordLookup
+from images import ImageStats, process_images
+from cache import PageCache, ResultCache
+from instrument import PipelineStats, log_stats
+from progress import Progress, print_event
+from spill import SpillFile
+from textclass import EOS, WIDE, char_class, has_cjk, last_nonspace
 import utils
 import epubgen
 
+# Heavy dependencies are imported on first use to keep startup fast
+np = utils.lazy_import('numpy')
+fitz = utils.lazy_import('fitz')
+
 # import nltk
 # nltk.download('words')
 # from nltk.corpus import words
@@ -21,7 +28,6 @@ import epubgen
 T = TypeVar('T')
 JsonLike = dict[str, Any]
 Block = JsonLike
-Span = JsonLike
 BlockIter = Iterator[Block]
 
 LineIter = Iterator[Line]
@@ -33,96 +39,318 @@ FontFlags = tuple[int, int]
 @dataclass
 class ConvertOptions:
     vertical: bool
+    # Number of processes used to extract pages; 1 extracts serially
+    jobs: int = 1
+    # Aggregate paragraphs a window of this many pages at a time instead of
+    # over the whole document, bounding memory; 0 disables streaming
+    stream_window: int = 0
+    # Start a new XHTML file once a chapter (or, with a table of contents,
+    # the part of a chapter written so far) has grown to this many
+    # characters
+    chapter_size: int = 256 * 1024
+    # Downsample images to this many pixels per inch of their displayed
+    # size and recompress them; 0 keeps images as they are
+    image_dpi: int = 0
+    # JPEG quality used when recompressing images
+    image_quality: int = 80
+    # Number of processes used to recompress images
+    image_workers: int = field(default_factory=lambda: os.cpu_count() or 1)
+    # Bound the memory used per page: MuPDF's caches are emptied every few
+    # pages, large images wait in a temporary file until they're written and
+    # paragraphs are aggregated in windows (of `LOW_MEMORY_WINDOW` pages,
+    # unless `stream_window` is set)
+    low_memory: bool = False
+    # Directory caching the lines extracted from each page, so converting a
+    # document again (with any options) doesn't parse it again; None
+    # disables the cache
+    page_cache: str | None = None
+    # Size limit of the page cache, in bytes
+    page_cache_size: int = 1 << 30
+    # How images are extracted: 'eager' reads them with the text, 'lazy'
+    # only locates them and reads them when they're written, and 'none'
+    # leaves them out
+    images: Literal['eager', 'lazy', 'none'] = 'eager'
+    # Text lines mostly set in at least this font size are headings, which
+    # are never merged with body text; 0 takes the smallest heading size
+    # found by the document statistics pre-pass
+    heading_size: float = 0
+
+
+# Identifies the pipeline in result cache keys; change it whenever a change
+# to the pipeline changes the ePub files it produces
+PIPELINE_VERSION = '4'
+
+
+def open_cache(root: str, max_bytes: int) -> ResultCache:
+    """Open a cache of conversion results, shared by every process that
+    opens the same directory."""
+
+    return ResultCache(root, max_bytes, PIPELINE_VERSION,
+                       ignored_options=('jobs', 'image_workers',
+                                        'page_cache', 'page_cache_size'))
 
 
 @utils.curry_first_arg
-def open_pdf(opt: ConvertOptions, src: str) -> fitz.Document:
-    """Open a PDF file using PyMuPDF."""
-
-    def merge_by_first(arr: Iterable[tuple[float, int]]) \
-            -> list[tuple[float, int]]:
-        dic = {}
-        for k, v in arr:
-            if k in dic:
-                dic[k] += v
-            else:
-                dic[k] = v
-        return [(k, v) for k, v in dic.items()]
-
-    def significant(arr: list[float]) -> int:
-        assert len(arr) > 0
-        bound = arr[0] * 0.2
-        for i in range(1, len(arr)):
-            if arr[i] < bound:
-                return i
-        return len(arr)
-
-    def analyze(page: fitz.Page) -> Iterator[Any]:
-        rect = page.rect
-        dic = page.get_text('dict')
-        blks = dic['blocks']
-        for blk in blks:
-            assert ('lines' in blk) or ('image' in blk)
-            if 'lines' in blk:
-                l, u, r, d = blk['bbox']
-                n_line = len(blk['lines'])
-                n_char = 0
-                text_sizes = []
-                for line in blk['lines']:
-                    text = ''
-                    for span in line['spans']:
-                        text += span['text']
-                        text_sizes.append((span['size'], len(span['text'])))
-                    n_char += len(text)
-                text_sizes = merge_by_first(text_sizes)
-                yield 'text', blk['bbox'], (n_line, n_char), text_sizes
-            if 'image' in blk:
-                yield 'image', blk['bbox']
-
-    doc = fitz.open(src)
-    toc = doc.get_toc()
-    metadata = doc.metadata
-    pages = list(doc.pages())
-    text_sizes = []
-    for page in pages:
-        for _, _, sizes in analyze(page):
-            text_sizes.extend(sizes)
-    text_sizes = merge_by_first(text_sizes)
-    text_sizes.sort(key=lambda x: x[1], reverse=True)
-    # print(*text_sizes, sep='\n')
-
-    return doc
-
-
-def extract_toc(src: str) -> list:
-    doc = fitz.open(src)
-    toc = doc.get_toc()
-    return [(t[0], t[1]) for t in toc]
-
-
-def extract_title(src: str) -> list:
-    doc = fitz.open(src)
-    metadata = doc.metadata
-    title = 'PDF2ePub' if 'title' not in metadata or metadata['title'] == '' else metadata['title']
-    return title
+def open_pdf(opt: ConvertOptions, src: str) -> Session:
+    """Open a PDF file using PyMuPDF.
+
+    The returned session is shared by every stage of a conversion so that
+    the document is only parsed once; close it (or use it as a context
+    manager) when the conversion is done."""
+
+    return Session(src)
+
+
+def analyze_document(opt: ConvertOptions, session: Session) \
+        -> DocumentStats:
+    """Estimate the statistics of a document from a sample of its pages,
+    once per session.
+
+    Sampled pages are extracted the way `extract_rawlines` would, and their
+    lines are kept in the session for it, so no page is parsed twice (when
+    extracting serially). In low-memory mode, their large images are
+    spilled meanwhile."""
+
+    if session.statistics is not None:
+        return session.statistics
+    page_cache = None
+    if opt.page_cache is not None:
+        page_cache = open_page_cache(opt, session.src, session.digest)
+    toc_pages = [entry[2] - 1 for entry in session.toc]
+    pages = []
+    for number in sample_pages(session.page_count, toc_pages):
+        lines, = extract_pages(session, number, number + 1, page_cache,
+                               opt.low_memory, opt.images)
+        if opt.low_memory:
+            lines = list(spill_images(session.spill, lines))
+        session.sampled_lines[number] = lines
+        pages.append(lines)
+    session.statistics = analyze(pages)
+    return session.statistics
+
+
+def resolve_options(opt: ConvertOptions, session: Session) \
+        -> ConvertOptions:
+    """Fill in options left to be decided from the document or from other
+    options. The document is only analyzed if an option depends on it."""
+
+    if opt.low_memory and opt.stream_window <= 0:
+        opt = replace(opt, stream_window=LOW_MEMORY_WINDOW)
+    if opt.heading_size <= 0:
+        sizes = analyze_document(opt, session).heading_sizes
+        opt = replace(opt, heading_size=sizes[-1] if len(sizes) > 0
+                      else float('inf'))
+    return opt
+
+
+def extract_toc(session: Session) -> list:
+    """Get (level, title, page) of each entry of the table of contents,
+    where page is 0-based, or -1 if the entry doesn't point to a page."""
+
+    return [(t[0], t[1], t[2] - 1 if t[2] > 0 else -1) for t in session.toc]
+
+
+def extract_title(session: Session) -> str:
+    return session.title
+
+
+def locate_images(page: 'fitz.Page') -> list[Line] | None:
+    """Image lines of a page holding only their geometry and a reference to
+    the image, or None if an image can't be located that way (e.g. one
+    drawn more than once)."""
+
+    lines = []
+    for item in page.get_images(full=True):
+        xref, _, width, height = item[:4]
+        bbox = page.get_image_bbox(item)
+        if bbox.is_empty or bbox.is_infinite:
+            return None
+        lines.append(ImageLine(tuple(bbox), page.number, None, width, height,
+                               LazyImage(page.parent.name, xref)))
+    return lines
+
+
+def place_images(texts: list[Line], images: list[Line]) -> list[Line]:
+    """Put image lines before the first text line below their top edge."""
+
+    lines = []
+    images = sorted(images, key=lambda line: line.bbox[1])
+    i = 0
+    for line in texts:
+        while i < len(images) and images[i].bbox[1] <= line.bbox[1]:
+            lines.append(images[i])
+            i += 1
+        lines.append(line)
+    lines.extend(images[i:])
+    return lines
+
+
+def extract_page_lines(page: 'fitz.Page',
+                       images: str = 'eager') -> Iterator[Line]:
+    """Returns the raw lines of a single page.
+
+    Unless `images` is 'eager', MuPDF is asked to leave images out of the
+    text, which saves decoding and re-encoding them. Lazily extracted
+    images are placed among text lines by vertical position rather than in
+    drawing order, so the output can differ from eager extraction: on pages
+    of several columns an image may land in the text of another column.
+    Inline images (those without an xref) are lost."""
+
+    if images != 'eager':
+        flags = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+        dic = page.get_text('dict', flags=flags)
+        texts = [make_line(line, LineType.TEXT, page.number)
+                 for blk in dic['blocks'] for line in blk['lines']]
+        if images == 'none':
+            yield from texts
+            return
+        located = locate_images(page)
+        if located is not None:
+            yield from place_images(texts, located)
+            return
+
+    dic = page.get_text('dict')
+    for blk in dic['blocks']:
+        assert 'lines' in blk or 'image' in blk
+        if 'lines' in blk:
+            for line in blk['lines']:
+                yield make_line(line, LineType.TEXT, page.number)
+        if 'image' in blk:
+            yield make_line(blk, LineType.IMAGE, page.number)
+
+
+def extract_pages(session: Session, start: int, stop: int,
+                  page_cache: PageCache | None = None,
+                  low_memory: bool = False,
+                  images: str = 'eager') -> Iterator[list[Line]]:
+    """Yield the raw lines of each page in [start, stop), reading them from
+    the page cache if given; MuPDF only parses pages that missed.
+
+    In low-memory mode, the resources MuPDF keeps for parsed pages (fonts,
+    decoded images...) are released every `LOW_MEMORY_WINDOW` pages; doing
+    it after every page would reload fonts all the time."""
+
+    for number in range(start, stop):
+        lines = session.sampled_lines.pop(number, None)
+        if lines is None and page_cache is not None:
+            lines = page_cache.get(number)
+        if lines is None:
+            lines = list(extract_page_lines(session.doc[number], images))
+            if page_cache is not None:
+                page_cache.put(number, lines)
+        if low_memory and (number + 1) % LOW_MEMORY_WINDOW == 0:
+            fitz.TOOLS.store_shrink(100)
+        yield lines
+
+
+def extract_page_range(opt: ConvertOptions, src: str, digest: str | None,
+                       start: int, stop: int) -> list[Line]:
+    """Open a PDF file and extract raw lines of pages in [start, stop).
+
+    This runs in a worker process of the parallel extraction pool, so it
+    opens its own copy of the document (and of the page cache, if the
+    document's `digest` is given)."""
+
+    page_cache = None
+    if digest is not None:
+        page_cache = open_page_cache(opt, src, digest)
+    with Session(src) as session:
+        return [line
+                for lines in extract_pages(session, start, stop, page_cache,
+                                           opt.low_memory, opt.images)
+                for line in lines]
+
+
+def open_page_cache(opt: ConvertOptions, src: str, digest: str) \
+        -> PageCache:
+    """Open the page cache of a document. Pages extracted with each image
+    mode are kept apart, since their lines differ."""
+
+    if opt.images != 'eager':
+        digest = '%s-%s' % (digest, opt.images)
+    return PageCache(opt.page_cache, digest, opt.page_cache_size,
+                     resolve=lambda xref: LazyImage(src, xref))
+
+
+def page_ranges(n_pages: int, n_chunks: int) -> list[tuple[int, int]]:
+    """Split pages into at most `n_chunks` contiguous, near-equal ranges."""
+
+    n_chunks = max(1, min(n_chunks, n_pages))
+    bounds = [n_pages * i // n_chunks for i in range(n_chunks + 1)]
+    return [(l, r) for l, r in zip(bounds[:-1], bounds[1:]) if l < r]
+
+
+# Documents shorter than this are always extracted serially, since starting
+# the pool would cost more than it saves.
+PARALLEL_MIN_PAGES = 32
+
+# Number of pages aggregated (and extracted by a worker) at a time in
+# low-memory mode
+LOW_MEMORY_WINDOW = 8
+
+# Images at least this large are spilled to disk in low-memory mode
+SPILL_MIN_BYTES = 16 * 1024
 
 
 @utils.curry_first_arg
-def extract_rawlines(opt: ConvertOptions, src: str) -> LineIter:
-    """Returns a text block iterator of a PDF file."""
-
-    doc = fitz.open(src)
-    for page in doc.pages():
-        dic = page.get_text('dict')
-        for blk in dic['blocks']:
-            assert 'lines' in blk or 'image' in blk
-            if 'lines' in blk:
-                for line in blk['lines']:
-                    line['page'] = page.number
-                    yield make_line(line, LineType.TEXT)
-            if 'image' in blk:
-                blk['page'] = page.number
-                yield make_line(blk, LineType.IMAGE)
+def extract_rawlines(opt: ConvertOptions, session: Session) -> LineIter:
+    """Returns a text block iterator of a PDF file.
+
+    With `opt.jobs > 1`, contiguous page ranges are extracted in a process
+    pool and merged back in page order, so later stages see exactly the same
+    line stream as in the serial case. With `opt.page_cache`, pages
+    extracted before are read from the cache instead, and the cache is
+    trimmed to its size once every page is stored."""
+
+    page_cache = digest = None
+    if opt.page_cache is not None:
+        digest = session.digest
+        page_cache = open_page_cache(opt, session.src, digest)
+
+    if opt.jobs <= 1 or session.page_count < PARALLEL_MIN_PAGES:
+        for lines in extract_pages(session, 0, session.page_count,
+                                   page_cache, opt.low_memory, opt.images):
+            yield from lines
+        if page_cache is not None:
+            page_cache.evict()
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    from collections import deque
+
+    # Workers extract sampled pages again rather than receive them
+    session.sampled_lines.clear()
+
+    # A few chunks per process keeps workers busy when pages are uneven
+    n_chunks = opt.jobs * 4
+    if opt.low_memory:
+        n_chunks = max(n_chunks, -(-session.page_count // LOW_MEMORY_WINDOW))
+    ranges = page_ranges(session.page_count, n_chunks)
+    with ProcessPoolExecutor(max_workers=opt.jobs) as executor:
+        # Only keep two chunks per process in flight, so that finished
+        # chunks don't pile up in memory when later stages are slower
+        futures = deque()
+        for l, r in ranges:
+            futures.append(executor.submit(extract_page_range, opt,
+                                           session.src, digest, l, r))
+            if len(futures) >= 2 * opt.jobs:
+                yield from futures.popleft().result()
+        while len(futures) > 0:
+            yield from futures.popleft().result()
+    if page_cache is not None:
+        page_cache.evict()
+
+
+def spill_images(spill: SpillFile, lines: LineIter) -> LineIter:
+    """Move the bytes of large images to a spill file until they're used."""
+
+    for line in lines:
+        # Lazily read images aren't in memory in the first place
+        if line_type(line) == LineType.IMAGE \
+                and isinstance(line.data, bytes) \
+                and len(line.data) >= SPILL_MIN_BYTES:
+            line.image = spill.store(line.image)
+        yield line
 
 
 def merge_bboxes(b1: BBox, b2: BBox) -> BBox:
@@ -133,68 +361,65 @@ def merge_bboxes(b1: BBox, b2: BBox) -> BBox:
 
 
 def merge_lines(l1: Line, l2: Line) -> Line:
-    """Merge two lines."""
+    """Merge the second line into the first one."""
 
-    line = l1.copy()
-    last_span = line['spans'][-1]
-    curr_span = l2['spans'][0]
+    line = l1
+    last_span = line.spans[-1]
+    curr_span = l2.spans[0]
     if span_equal_up_to_props(last_span, curr_span):
-        new_span = merge_spans(last_span, curr_span)
-        line['spans'][-1] = new_span
-        line['spans'].extend(l2['spans'][1:])
+        new_span = merge_spans(last_span, curr_span, line_break=True)
+        line.spans[-1] = new_span
+        line.spans.extend(l2.spans[1:])
     else:
-        line['spans'].extend(l2['spans'])
-    line['bbox'] = merge_bboxes(line['bbox'], l2['bbox'])
+        line.spans.extend(l2.spans)
+    line.bbox = merge_bboxes(line.bbox, l2.bbox)
     return line
 
 
 def span_equal_up_to_props(s1: Span, s2: Span) -> bool:
-    """Whether two spans have same properties."""
+    """Whether two spans have same properties.
+
+    Styles are interned, so comparing them is an identity check."""
 
-    return len(s1['text']) == 0 or len(s2['text']) == 0 \
-           or (s1['size'] == s2['size']
-               and s1['flags'] == s2['flags']
-               and s1['color'] == s2['color'])
+    return len(s1.text) == 0 or len(s2.text) == 0 \
+           or s1.style is s2.style
 
 
 def fix_whitespace(prev_text: str, text: str) -> str:
     """Add a space when it's appropriate."""
 
-    prev_text = prev_text.rstrip()
-    if len(prev_text) == 0:
+    # The previous text may be a whole paragraph, so it isn't stripped
+    # (copied); trailing whitespace can't be part of '://' anyway
+    end = last_nonspace(prev_text)
+    if end < 0:
         return text
-    prev_char = prev_text[-1]
-    if unicodedata.east_asian_width(prev_char) in ('F', 'W', 'A') \
-            or prev_char.isspace() \
-            or prev_char in '-' \
+    prev_char = prev_text[end]
+    if char_class(prev_char) & WIDE \
+            or prev_char == '-' \
             or '://' in prev_text:
         return text.lstrip()
     return ' ' + text.lstrip()
 
 
-with lzma.open('words.xz', 'rb') as f:
-    english_words_ = pickle.load(f)
+# The lexicon is mapped lazily on the first lookup
+english_words_ = WordLookup(Lexicon())
 
 
 def is_english_word(word: str) -> bool:
     """Check whether a string is a word in English."""
 
-    return word in english_words_ \
-           or len(word) > 1 and word[:-1] in english_words_ \
-           or len(word) > 2 and word[:-2] in english_words_ \
-           or len(word) > 3 and word[:-3] in english_words_ \
-           or word.replace('ing', 'e') in english_words_ \
-           or word.replace('ion', 'e') in english_words_ \
-           or word.replace('ied', 'y') in english_words_ \
-           or word.replace('ies', 'y') in english_words_
+    # Upper-casing first expands ligatures and ß ('ﬁ' to 'FI'), so the
+    # memo is keyed on the normalized word
+    return word.upper().lower() in english_words_
 
 
-def merge_texts(t1: str, t2: str) -> str:
+def merge_texts(t1: str, t2: str, line_break: bool = False) -> str:
     """Merges two pieces of text.
 
-    Remove hyphens when appropriate."""
+    At a line break, remove the hyphen ending the first piece if it splits
+    a word; elsewhere (e.g. between spans of a line) hyphens are kept."""
 
-    if len(t1) >= 2 and t1[-1] == '-' and t1[-2].isalpha():
+    if line_break and len(t1) >= 2 and t1[-1] == '-' and t1[-2].isalpha():
         t1 = t1[:-1]
         i, j = -1, 0
         while -i <= len(t1) and t1[i].isalpha():
@@ -203,31 +428,31 @@ def merge_texts(t1: str, t2: str) -> str:
             j += 1
         ll, lr, rl, rr = t1[:i + 1], t1[i + 1:], t2[:j], t2[j:]
         word = lr + rl
-        if is_english_word(word.upper().lower()):
+        if is_english_word(word):
             return ll + word + rr
         else:
             return ll + lr + '-' + rl + rr
     return t1 + fix_whitespace(t1, t2)
 
 
-def merge_spans(s1: Span, s2: Span) -> Span:
-    """Merge text of two spans and fix whitespace."""
+def merge_spans(s1: Span, s2: Span, line_break: bool = False) -> Span:
+    """Merge text of two spans and fix whitespace; `line_break` tells
+    whether the second span starts a new line."""
 
-    span = s1.copy()
-    if len(span['text']) == 0:
-        span['text'] = s2['text']
-    if len(s2['text']) > 0:
-        span['text'] = merge_texts(span['text'], s2['text'])
-    span['bbox'] = merge_bboxes(span['bbox'], s2['bbox'])
-    return span
+    text = s1.text
+    if len(text) == 0:
+        text = s2.text
+    if len(s2.text) > 0:
+        text = merge_texts(text, s2.text, line_break)
+    return Span(text, merge_bboxes(s1.bbox, s2.bbox), s1.style)
 
 
 def line_bbox(line: Line) -> BBox:
     """Gets the bounding box of a line by merging span bounding boxes."""
 
     bbox = (float('+inf'), float('+inf'), float('-inf'), float('-inf'))
-    for span in line['spans']:
-        bbox = merge_bboxes(bbox, span['bbox'])
+    for span in line.spans:
+        bbox = merge_bboxes(bbox, span.bbox)
     return bbox
 
 
@@ -240,7 +465,7 @@ def splice_horizontal_rawlines(lines: LineIter) -> LineIter:
         box."""
 
         ml, mu, mr, md = bbox
-        l, u, r, d = span['bbox']
+        l, u, r, d = span.bbox
         return mu < (u + d) / 2 < md
 
     last_line = None
@@ -251,25 +476,27 @@ def splice_horizontal_rawlines(lines: LineIter) -> LineIter:
         # Do case analysis on the type tags of (last_line, line)
         ts = (line_type(last_line), line_type(line))
         if ts == (LineType.TEXT, LineType.TEXT):
-            pred = lambda s: within_vertical_span(last_line['bbox'], s)
-            t, f = utils.split_on(pred, line['spans'])
+            pred = lambda s: within_vertical_span(last_line.bbox, s)
+            t, f = utils.split_on(pred, line.spans)
             # Add a space when appropriate
-            if len(t) > 0 and len(last_line['spans']) > 0:
-                prev_text = last_line['spans'][-1]['text']
-                t[0]['text'] = fix_whitespace(prev_text, t[0]['text'])
-            last_line['spans'].extend(t)
+            if len(t) > 0 and len(last_line.spans) > 0:
+                prev_text = last_line.spans[-1].text
+                t[0].text = fix_whitespace(prev_text, t[0].text)
+            last_line.spans.extend(t)
             # Don't stream the current line if it belongs to the last line
             if len(f) == 0:
                 continue
-            line['spans'] = f
+            line.spans = f
             # Re-calculate line bounding box after modifying its spans
-            last_line['bbox'] = line_bbox(last_line)
-            line['bbox'] = line_bbox(line)
+            last_line.bbox = line_bbox(last_line)
+            line.bbox = line_bbox(line)
         yield last_line
         last_line = line
+    if last_line is None:
+        return
     t = line_type(last_line)
     if t == LineType.TEXT:
-        if len(last_line['spans']) > 0:
+        if len(last_line.spans) > 0:
             yield last_line
     elif t == LineType.IMAGE:
         yield last_line
@@ -286,10 +513,10 @@ def splice_vertical_rawlines(lines: LineIter) -> LineIter:
         below the bounding box of the last span of the last line, by comparing
         the horizontal height of the mid-point of the bounding boxes."""
 
-        if len(last_line['spans']) == 0 or len(line['spans']) == 0:
+        if len(last_line.spans) == 0 or len(line.spans) == 0:
             return True
-        _, pu, _, pd = last_line['spans'][-1]['bbox']
-        _, cu, _, cd = line['spans'][-1]['bbox']
+        _, pu, _, pd = last_line.spans[-1].bbox
+        _, cu, _, cd = line.spans[-1].bbox
         return cu + cd > pu + pd
 
     last_line = None
@@ -301,12 +528,16 @@ def splice_vertical_rawlines(lines: LineIter) -> LineIter:
         ts = (line_type(last_line), line_type(line))
         if ts == (LineType.TEXT, LineType.TEXT):
             if should_splice(last_line, line):
-                last_line['spans'].extend(line['spans'])
+                last_line.spans.extend(line.spans)
                 continue
-        last_line['bbox'] = line_bbox(last_line)
+        if line_type(last_line) == LineType.TEXT:
+            last_line.bbox = line_bbox(last_line)
         yield last_line
         last_line = line
-    last_line['bbox'] = line_bbox(last_line)
+    if last_line is None:
+        return
+    if line_type(last_line) == LineType.TEXT:
+        last_line.bbox = line_bbox(last_line)
     yield last_line
 
 
@@ -321,8 +552,10 @@ def splice_rawlines(opt: ConvertOptions) -> Callable[[LineIter], LineIter]:
 
 @utils.curry_first_arg
 def reformat_rawlines(opt: ConvertOptions, lines: LineIter) -> LineIter:
-    """Rectify and simplify spans, merge spans that have same properties,
-    remove unused properties from lines."""
+    """Rectify spans and merge spans that have same properties."""
+
+    # Raw styles are interned, so each distinct one is reformatted only once
+    reformatted_styles = {}
 
     def reformat_text_line_span(span: Span) -> Span:
         """Reformat font flags and font color of a span."""
@@ -352,29 +585,20 @@ def reformat_rawlines(opt: ConvertOptions, lines: LineIter) -> LineIter:
 
             return '#' + hex(color)[2:].zfill(6)
 
-        span['flags'] = reformat_flags(span['flags'])
-        span['color'] = reformat_color(span['color'])
+        raw = span.style
+        if raw not in reformatted_styles:
+            size, flags, color = raw
+            reformatted_styles[raw] = intern_style(
+                (size, reformat_flags(flags), reformat_color(color)))
+        span.style = reformatted_styles[raw]
         return span
 
-    def simplify_text_line_span(span: Span) -> Span:
-        """Remove unused properties from a text line span."""
-
-        props = ['size', 'flags', 'color', 'text', 'bbox']
-        return utils.filter_dict_by(props, span)
-
-    def simplify_text_line(line: Line) -> Line:
-        """Remove unused properties from a text line."""
-
-        props = ['spans', 'bbox', 'page']
-        line = utils.filter_dict_by(props, line)
-        return make_line(line, LineType.TEXT)
-
     def merge_spans_of_a_text_line(line: Line) -> Line:
         """Merge spans of a text line that have same properties."""
 
         spans = []
         last_span = None
-        for span in line['spans']:
+        for span in line.spans:
             if last_span is None:
                 last_span = span
                 continue
@@ -384,7 +608,7 @@ def reformat_rawlines(opt: ConvertOptions, lines: LineIter) -> LineIter:
                 spans.append(last_span)
                 last_span = span
         spans.append(last_span)
-        line['spans'] = spans
+        line.spans = spans
         return line
 
     def span_level(process: Callable[[Span], Span]) \
@@ -392,15 +616,13 @@ def reformat_rawlines(opt: ConvertOptions, lines: LineIter) -> LineIter:
         """Apply a processor (function) to all spans in a line."""
 
         def line_processor(line: Line) -> Line:
-            line['spans'] = [process(span) for span in line['spans']]
+            line.spans = [process(span) for span in line.spans]
             return line
 
         return line_processor
 
     text_line_steps = [
         span_level(reformat_text_line_span),
-        span_level(simplify_text_line_span),
-        simplify_text_line,
         merge_spans_of_a_text_line
     ]
     for line in lines:
@@ -420,27 +642,24 @@ def aggregate_lines(opt: ConvertOptions, lines: LineIter) -> LineIter:
     def is_eos(text: str) -> bool:
         """Whether a piece of text is at the end of a sentence."""
 
-        stripped = text.strip()
-        if len(stripped) == 0:
+        end = last_nonspace(text)
+        if end < 0 or not char_class(text[end]) & EOS:
             return False
-        eos = stripped[-1] in '。.！!？?”"…'
+        if text[end] != '.':
+            return True
         # Example: https://example.com
-        url = stripped[-1] == '.' \
-              and '://' in stripped
+        url = '://' in text
         # Example: Donald E. Knuth
-        nym = len(stripped) >= 2 \
-              and stripped[-1] == '.' \
-              and stripped[-2].isupper()
-        # Example: i.e., e.g., s.t.
-        lat = len(stripped) >= 4 \
-              and stripped[-1] == '.' \
-              and stripped[-3] == '.'
-        return eos and not (url or nym or lat)
+        nym = end >= 1 and text[end - 1].isupper()
+        # Example: i.e., e.g., s.t. (with a character before the abbreviation)
+        lat = end >= 3 and text[end - 2] == '.' \
+              and not text[:end - 2].isspace()
+        return not (url or nym or lat)
 
     def line_text(line: Line) -> str:
         """Concatenate pieces of text within a line into one."""
 
-        return ''.join(span['text'] for span in line['spans'])
+        return ''.join(span.text for span in line.spans)
 
     def tagged(lines: LineIter) -> Iterator[tuple[Line, bool]]:
         """Analyze lines and return a tuple for each line containing the line
@@ -453,43 +672,44 @@ def aggregate_lines(opt: ConvertOptions, lines: LineIter) -> LineIter:
             vertically typesetted."""
 
             if opt.vertical:
-                u, l, d, r = line['bbox']
+                u, l, d, r = line.bbox
             else:
-                l, u, r, d = line['bbox']
+                l, u, r, d = line.bbox
             return l, u, r, d
 
-        def column_lrs(lrs: list[tuple[float, float]]) \
+        def column_lrs(ls: np.ndarray, rs: np.ndarray) \
                 -> list[tuple[float, float]]:
-            if len(lrs) == 0:
+            """Find columns as the gaps between runs of sparsely covered
+            integer positions, given L and R positions of lines."""
+
+            if len(ls) == 0:
                 return []
-            cnt = []
-
-            def inc(l: int, r: int) -> None:
-                if r >= len(cnt):
-                    cnt.extend([0] * (r + 1 - len(cnt)))
-                for i in range(l, r + 1):
-                    cnt[i] += 1
-
-            def cluster(lst: list[int]) -> list[int]:
-                res = []
-                left, last = -100, -100
-                for x in lst + [-1]:
-                    if x == last + 1:
-                        last = x
-                    else:
-                        res.append(round((left + last) / 2))
-                        left, last = x, x
-                return res[1:]
-
-            for l, r in lrs:
-                inc(math.ceil(l), math.floor(r))
-            lb = max(cnt) * 0.3
-            delim = cluster([c for c in range(len(cnt)) if cnt[c] < lb])
+            # Coverage histogram of [ceil(l), floor(r)] via a difference array
+            lefts = np.ceil(ls).astype(np.int64)
+            rights = np.floor(rs).astype(np.int64)
+            # Text running off the page has negative positions, which can't
+            # be counted; shift positions to start at 0 and shift back after
+            offset = min(0, lefts.min(), rights.min())
+            lefts -= offset
+            rights -= offset
+            n = rights.max() + 1
+            nonempty = lefts <= rights
+            diff = np.bincount(lefts[nonempty], minlength=n + 1) \
+                - np.bincount(rights[nonempty] + 1, minlength=n + 1)
+            cnt = np.cumsum(diff[:n])
+            lb = cnt.max() * 0.3
+            # Middle points of runs of consecutive sparse positions
+            sparse = np.flatnonzero(cnt < lb)
+            if len(sparse) > 0:
+                breaks = np.flatnonzero(np.diff(sparse) != 1)
+                starts = sparse[np.concatenate(([0], breaks + 1))]
+                ends = sparse[np.concatenate((breaks, [len(sparse) - 1]))]
+                delim = (np.round((starts + ends) / 2) + offset).tolist()
+            else:
+                delim = []
             if cnt[-1] >= lb:
-                delim.append(len(cnt) + 10)
-            delim = list(map(float, delim))
-            delim = list(zip(delim[:-1], delim[1:]))
-            return delim
+                delim.append(float(n + offset + 10))
+            return list(zip(delim[:-1], delim[1:]))
 
         def within_column(col: tuple[float, float],
                           lr: tuple[float, float]) -> bool:
@@ -499,32 +719,48 @@ def aggregate_lines(opt: ConvertOptions, lines: LineIter) -> LineIter:
             l, r = lr
             return lm - k * ran < l and r < rm + k * ran
 
-        def column_bounds(col: tuple[float, float],
-                          ls: list[float],
-                          rs: list[float]) -> tuple[float, float]:
+        def column_bounds(cols: list[tuple[float, float]],
+                          ls: np.ndarray,
+                          rs: np.ndarray) -> list[tuple[float, float]]:
+            """Get the bounds of L and R positions of lines within each
+            column, computed for all columns at once."""
 
-            def bounds(arr: list[float]) -> tuple[float, float]:
-                arr = np.array(arr)
-                mean = arr.mean()
-                var = math.sqrt(((arr - mean) ** 2).mean())
-                lb = mean - 1.96 * var
-                ub = mean + 1.96 * var
-                return lb, ub
+            if len(cols) == 0:
+                return []
+            lms, rms = np.array(cols).T[:, :, None]
+            k = 0.05
+            ran = rms - lms
+            within = (lms - k * ran < ls) & (rs < rms + k * ran)
+            n = within.sum(axis=1)
+            # Columns without lines (possible with few lines, e.g. within a
+            # streaming window) are bounded by themselves
+            empty = n == 0
+            n = np.maximum(n, 1)
+
+            def bounds(arr: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+                mean = np.where(within, arr, 0.0).sum(axis=1) / n
+                dev = np.where(within, arr - mean[:, None], 0.0)
+                var = np.sqrt((dev ** 2).sum(axis=1) / n)
+                return mean - 1.96 * var, mean + 1.96 * var
 
-            pred = utils.curry_first_arg(within_column)(col)
-            ls, rs = zip(*filter(pred, zip(ls, rs)))
             l_lb, l_ub = bounds(ls)
             r_lb, r_ub = bounds(rs)
-            return l_ub, r_lb
+            l_ub = np.where(empty, lms[:, 0], l_ub)
+            r_lb = np.where(empty, rms[:, 0], r_lb)
+            return list(zip(l_ub.tolist(), r_lb.tolist()))
 
         def columns_and_bounds(ls: list[float], rs: list[float]) \
                 -> list[tuple[tuple[float, float], tuple[float, float]]]:
-            cols = column_lrs([(l, r) for l, r in zip(ls, rs)])
-            bds = [column_bounds(col, ls, rs) for col in cols]
+            ls, rs = np.array(ls, dtype=float), np.array(rs, dtype=float)
+            cols = column_lrs(ls, rs)
+            bds = column_bounds(cols, ls, rs)
             return list(zip(cols, bds))
 
-        def columns_and_bounds_for_text_lines(lines: list[Line]) \
-                -> list[tuple[tuple[float, float], tuple[float, float]]]:
+        def text_line_lrs(lines: list[Line]) \
+                -> tuple[list[float], list[float]]:
+            """Get L and R positions of text lines that don't end a
+            sentence, which are what the column model is built from."""
+
             ls, rs = [], []
             for line in lines:
                 t = line_type(line)
@@ -535,19 +771,34 @@ def aggregate_lines(opt: ConvertOptions, lines: LineIter) -> LineIter:
                 if not is_eos(text):
                     ls.append(l)
                     rs.append(r)
-            return columns_and_bounds(ls, rs)
+            return ls, rs
+
+        pred = lambda line: line.page % 2 == 0
 
-        lines = list(lines)
-        pred = lambda line: line['page'] % 2 == 0
-        odd_page_lines, even_page_lines = utils.split_on(pred, lines)
-        odd_col_bd = columns_and_bounds_for_text_lines(odd_page_lines)
-        even_col_bd = columns_and_bounds_for_text_lines(even_page_lines)
+        def parity_lrs(lines: list[Line]) -> list[tuple[list, list]]:
+            """Column geometry of lines on even pages and on odd pages, since
+            the two may be typeset with different margins."""
 
-        def is_eoc(line: Line) -> bool:
+            return list(map(text_line_lrs, utils.split_on(pred, lines)))
+
+        def model_of(geometries: list[list[tuple[list, list]]]) -> list:
+            """Build columns and bounds for both page parities from one or
+            more pieces of geometry."""
+
+            model = []
+            for parity in range(2):
+                ls, rs = [], []
+                for geometry in geometries:
+                    ls.extend(geometry[parity][0])
+                    rs.extend(geometry[parity][1])
+                model.append(columns_and_bounds(ls, rs))
+            return model
+
+        def is_eoc(model: list, line: Line) -> bool:
             """Whether a right side of a line is at the end of a column."""
 
             l, _, r, _ = get_lurd(line)
-            col_bd = odd_col_bd if pred(line) else even_col_bd
+            col_bd = model[0] if pred(line) else model[1]
             for col, bd in col_bd:
                 if within_column(col, (l, r)):
                     _, rb = bd
@@ -555,28 +806,67 @@ def aggregate_lines(opt: ConvertOptions, lines: LineIter) -> LineIter:
             return False
 
         def is_title(line: Line) -> bool:
+            """Whether a line is (part of) a heading: set mostly in a
+            heading size and not punctuated like a sentence."""
+
             t = line_type(line)
             if t != LineType.TEXT:
                 return False
             text = line_text(line)
             if any(c in text for c in '，。,'):
                 return False
-            # print(text)
-            return False
+            n_large = sum(len(span.text) for span in line.spans
+                          if span.style[0] >= opt.heading_size - 0.25)
+            return n_large * 2 > len(text)
 
-        sm = [False]
-        for line, next_line in zip(lines[:-1], lines[1:]):
-            t = line_type(line)
-            if t == LineType.TEXT:
-                _, u, r, d = get_lurd(line)
-                # _, u_next, _, d_next = get_lurd(next_line)
-                is_title(line)
-                line_sm = not is_eos(line_text(line)) \
-                          and is_eoc(line)
-                sm.append(line_sm)
-            elif t == LineType.IMAGE:
-                sm.append(False)
-        return zip(lines, sm)
+        def tag(model: list, lines: Iterable[Line], prev: Line | None) \
+                -> Iterator[tuple[Line, bool]]:
+            """Tag each line based on the line before it, which is `prev`
+            for the first one."""
+
+            for line in lines:
+                if prev is None:
+                    yield line, False
+                elif line_type(prev) == LineType.TEXT:
+                    # Headings and body text are never merged
+                    yield line, is_title(prev) == is_title(line) \
+                                and not is_eos(line_text(prev)) \
+                                and is_eoc(model, prev)
+                else:
+                    yield line, False
+                prev = line
+
+        def windows(lines: LineIter) -> Iterator[list[Line]]:
+            """Group lines into lists that span `opt.stream_window` pages."""
+
+            window, pages, last_page = [], 0, None
+            for line in lines:
+                if line.page != last_page:
+                    if pages == opt.stream_window:
+                        yield window
+                        window, pages = [], 0
+                    pages += 1
+                    last_page = line.page
+                window.append(line)
+            if len(window) > 0:
+                yield window
+
+        if opt.stream_window <= 0:
+            lines = list(lines)
+            return tag(model_of([parity_lrs(lines)]), lines, None)
+
+        def tagged_by_window() -> Iterator[tuple[Line, bool]]:
+            """Tag lines a window at a time, with the model built from the
+            geometry of the current and the previous window."""
+
+            prev, prev_geometry = None, [([], []), ([], [])]
+            for window in windows(lines):
+                geometry = parity_lrs(window)
+                model = model_of([prev_geometry, geometry])
+                yield from tag(model, window, prev)
+                prev, prev_geometry = window[-1], geometry
+
+        return tagged_by_window()
 
     last_line = None
     for line, should_merge in tagged(lines):
@@ -593,29 +883,37 @@ def aggregate_lines(opt: ConvertOptions, lines: LineIter) -> LineIter:
 
 
 @utils.curry_first_arg
-def to_epub(opt: ConvertOptions, title, toc, lines: LineIter) -> str:
-    """Make an ePub file from lines (paragraphs) and meta information."""
+def to_epub(opt: ConvertOptions, title, toc, lines: LineIter,
+            dest: str | None = None) -> str:
+    """Make an ePub file from lines (paragraphs) and meta information.
+
+    The file is written to `dest`, or to a temporary path if not given;
+    returns its path."""
+
+    escape = epubgen.escape
 
-    def toc_to_html(toc):
+    def write_toc(toc) -> None:
         if len(toc) == 0:
-            return ''
-        title = '目录' if any(0x4e00 <= ord(ch) <= 0x9fff for ch in ''.join(t[1] for t in toc)) else 'Table of Contents'
-        html = '<h2>%s</h2><div style="line-height: 0; margin-bottom: 50vh;">' % (title,)
+            return
+        title = '目录' if any(has_cjk(t[1]) for t in toc) else 'Table of Contents'
+        writer.write('<h2>%s</h2><div style="line-height: 0; margin-bottom: 50vh;">' % (title,))
         for t in toc:
-            html += '<p style="margin-left: %dpx;">' % ((t[0] - 1) * 20,) + t[1] + '</p>'
-        html += '</div>'
-        return html
-        # if not isinstance(toc, list):
-        #     return toc
-        # return ''.join('<p>%s</p>' % (h + '.%d ' % (i + 1,) + toc_to_html(j, h + '.%d' % (n,), n + 1),) for i, j in enumerate(toc))
-
-    def span_to_html(span: Span) -> str:
-        """Make a span a HTML tag."""
-
-        beg, end = '<span style="%s">', '</span>'
-        content = html.escape(span['text'])
+            writer.write('<p style="margin-left: %dpx;">' % ((t[0] - 1) * 20,))
+            writer.write(escape(t[1]))
+            writer.write('</p>')
+        writer.write('</div>')
+
+    # CSS class of each (interned) style
+    span_classes = {}
+
+    def span_css(span: Span) -> str:
+        """Make CSS declarations for the style of a span.
+
+        Every property is set explicitly, since a span may be nested in a
+        paragraph of another style."""
+
         styles = []
-        cate, fl = span['flags']
+        cate, fl = span.flags
         if cate == 0:
             styles.append('font-family:serif')
         elif cate == 1:
@@ -625,41 +923,100 @@ def to_epub(opt: ConvertOptions, title, toc, lines: LineIter) -> str:
             styles.append('font-family:monospace')
         if fl & 1 << 0:
             styles.append('vertical-align:super')
-        if fl & 1 << 1:
-            styles.append('font-style:italic')
-        if fl & 1 << 2:
-            styles.append('font-weight:bold')
-        styles.append('color:' + span['color'])
-        return beg % ';'.join(styles) + content + end
-
-    def image_to_html(line: Line) -> str:
-        tag = '<img width="{width}" height="{height}" src="data:image/{ext};base64,{data}" />'
-        return tag.format(
-            width=line['width'],
-            height=line['height'],
-            ext=line['ext'],
-            data=base64.b64encode(line['image']).decode())
-
-    def lines_to_html(lines: LineIter) -> str:
-        """Convert lines (paragraphs) to an HTML fragment."""
-
-        pars = []
+        styles.append('font-style:%s' % ('italic' if fl & 1 << 1 else 'normal',))
+        styles.append('font-weight:%s' % ('bold' if fl & 1 << 2 else 'normal',))
+        styles.append('color:' + span.color)
+        return ';'.join(styles)
+
+    def span_class(span: Span) -> str:
+        cls = span_classes.get(span.style)
+        if cls is None:
+            cls = span_classes[span.style] = writer.add_style(span_css(span))
+        return cls
+
+    def dominant_span(line: Line) -> Span | None:
+        """The span whose style covers most of the text of a paragraph, if
+        that style can be set on the paragraph itself."""
+
+        lengths = {}
+        best, best_len = None, 0
+        for span in line.spans:
+            n = lengths[span.style] = lengths.get(span.style, 0) + len(span.text)
+            if n > best_len:
+                best, best_len = span, n
+        # Superscript doesn't apply to block elements
+        if best is None or best.flags[1] & 1 << 0:
+            return None
+        return best
+
+    def write_text_line(line: Line) -> None:
+        dominant = dominant_span(line)
+        if dominant is None:
+            cls = None
+            writer.write('<p>')
+        else:
+            cls = span_class(dominant)
+            writer.write('<p class="%s">' % (cls,))
+        for span in line.spans:
+            if len(span.text) == 0:
+                continue
+            # Distinct styles may still look the same, e.g. differing only
+            # in size, which isn't part of the CSS
+            if span_class(span) == cls:
+                writer.write(escape(span.text))
+            else:
+                writer.write('<span class="%s">' % (span_class(span),))
+                writer.write(escape(span.text))
+                writer.write('</span>')
+        writer.write('</p>')
+
+    def write_image(line: Line) -> None:
+        tag = '<img width="{width}" height="{height}" src="{src}" />'
+        # Read the image first: the type of a lazily read image is only
+        # known then
+        image = line.image
+        writer.write(tag.format(
+            width=line.width,
+            height=line.height,
+            src=writer.add_image(image, line.ext)))
+
+    def write_line(line: Line) -> None:
+        """Write a line (paragraph) as an HTML paragraph."""
+
+        t = line_type(line)
+        if t == LineType.TEXT:
+            write_text_line(line)
+        elif t == LineType.IMAGE:
+            writer.write('<p>')
+            write_image(line)
+            writer.write('</p>')
+
+    # Entries pointing to a page, in page order; the top-level ones start
+    # new chapters
+    entries = sorted(((i, t) for i, t in enumerate(toc) if t[2] >= 0),
+                     key=lambda e: e[1][2])
+    top_level = min((t[0] for _, t in entries), default=0)
+
+    with epubgen.open_epub(title, dest) as writer:
+        write_toc(toc)
+        k = 0
         for line in lines:
-            t = line_type(line)
-            if t == LineType.TEXT:
-                pars.append(''.join(map(span_to_html, line['spans'])))
-            elif t == LineType.IMAGE:
-                pars.append(image_to_html(line))
-        return ''.join('<p>' + par + '</p>' for par in pars)
-
-    html_data = toc_to_html(toc) + lines_to_html(lines)
-    # Filter control characters
-    html_data = ''.join(ch for ch in html_data if not (ord(ch) < 32 or ord(ch) == 127))
-    epub_data = epubgen.EpubData(
-        title=title,
-        html=html_data
-    )
-    return epubgen.create_epub(epub_data)
+            # Mark (and maybe start a chapter for) entries up to this page
+            while k < len(entries) and entries[k][1][2] <= line.page:
+                i, (level, label, _) = entries[k]
+                if level == top_level and writer.size > 0:
+                    writer.begin_chapter(label)
+                writer.write('<div id="toc-%d"></div>' % (i,))
+                writer.add_nav_point(level, label, 'toc-%d' % (i,))
+                k += 1
+            if writer.size >= opt.chapter_size:
+                # Split long chapters, keeping the title of the entry
+                writer.begin_chapter(writer.chapters[-1].title)
+            write_line(line)
+        for i, (level, label, _) in entries[k:]:
+            writer.write('<div id="toc-%d"></div>' % (i,))
+            writer.add_nav_point(level, label, 'toc-%d' % (i,))
+    return writer.path
 
 
 @utils.curry_first_arg
@@ -670,33 +1027,142 @@ def to_list(opt: ConvertOptions, lines: LineIter) -> list[str]:
     for i, line in enumerate(lines):
         t = line_type(line)
         if t == LineType.TEXT:
-            par = ''.join(span['text'] for span in line['spans']) \
+            par = ''.join(span.text for span in line.spans) \
                 .replace(' ', '')
             lst.append(par)
         elif t == LineType.IMAGE:
             par = '[Image witdh=%d height=%d]' % \
-                  (line['width'], line['height'])
+                  (line.width, line.height)
             lst.append(par)
     return lst
 
 
-def convert(opt: ConvertOptions, src: str) -> Any:
-    # Pass options to each step function as its first argument
-    def apply_to(src, steps):
-        data = src
-        for step in steps:
-            data = step(data)
-        return data
-
-    title = extract_title(src)
-    toc = extract_toc(src)
-    pars = apply_to(src, map(lambda fn: fn(opt), [
+@utils.curry_first_arg
+def recompress_images(opt: ConvertOptions, lines: LineIter,
+                      stats: ImageStats | None = None) -> LineIter:
+    """Downsample and recompress images if `opt.image_dpi` is set."""
+
+    if opt.image_dpi <= 0:
+        return lines
+    return process_images(opt.image_dpi, opt.image_quality,
+                          opt.image_workers, lines, stats)
+
+
+def convert_session(opt: ConvertOptions, session: Session,
+                    dest: str | None = None,
+                    image_stats: ImageStats | None = None,
+                    stats: PipelineStats | None = None,
+                    progress: Progress | None = None) -> Any:
+    """Convert an open document; if `stats` is given, every stage is
+    metered into it, and if `progress` is given, progress events are
+    reported to it."""
+
+    # Styles are interned per conversion, or the table would grow with
+    # every document a server or batch worker converts
+    clear_styles()
+    title = extract_title(session)
+    toc = extract_toc(session)
+    steps = [
         extract_rawlines,
         splice_rawlines,
         reformat_rawlines,
         aggregate_lines
-    ]))
-    epub = to_epub(opt)(title, toc, pars)
+    ]
+    if progress is not None:
+        progress.event('analyze', force=True, pages=session.page_count)
+
+    def track(step, lines: LineIter) -> LineIter:
+        """Spill images after extraction in low-memory mode, and report the
+        progress of extraction and writing by watching the lines coming out
+        of them."""
+
+        if step is extract_rawlines and opt.low_memory:
+            lines = spill_images(session.spill, lines)
+        if progress is None:
+            return lines
+        if step is extract_rawlines:
+            return progress.pages('extract', lines, session.page_count)
+        if step is to_epub:
+            return progress.pages('write', lines, session.page_count)
+        return lines
+
+    def done(epub: str) -> str:
+        if progress is not None:
+            progress.event('done', force=True, pages=session.page_count)
+        return epub
+
+    def count_spans(sign: int) -> Callable[[Line], None]:
+        """Count spans going into (+1) and out of (-1) a stage as merged."""
+
+        def count(line: Line) -> None:
+            if line_type(line) == LineType.TEXT:
+                stats.count('spans_merged', sign * len(line.spans))
+
+        return count
+
+    def count_pars(line: Line) -> None:
+        stats.count('paragraphs' if line_type(line) == LineType.TEXT
+                    else 'images')
+
+    def run(step, fn: Callable[[Any], Iterable], lines: Any) -> LineIter:
+        """Apply a stage, metered if `stats` is given."""
+
+        if not metered:
+            return fn(lines)
+        if step is reformat_rawlines:
+            return stats.run(step.__name__, fn, lines,
+                             on_input=count_spans(1),
+                             on_output=count_spans(-1))
+        return stats.run(step.__name__, fn, lines)
+
+    def write(lines: LineIter) -> str:
+        return to_epub(opt)(title, toc, lines, dest)
+
+    metered = stats is not None
+    with stats.sample_memory() if metered else nullcontext():
+        with stats.measure('analyze_document') if metered else nullcontext():
+            opt = resolve_options(opt, session)
+        if metered and session.statistics is not None:
+            stats.document = asdict(session.statistics)
+        # Pass options to each step function as its first argument
+        stages = [(step, step(opt)) for step in steps]
+        stages.append((recompress_images,
+                       lambda lines: recompress_images(opt)(lines,
+                                                            image_stats)))
+        pars = session
+        for step, fn in stages:
+            pars = track(step, run(step, fn, pars))
+        pars = track(to_epub, pars)
+        if not metered:
+            return done(write(pars))
+        epub = stats.call('to_epub', write, pars, on_input=count_pars)
+    stats.count('bytes_written', os.path.getsize(epub))
+    return done(epub)
+
+
+def convert(opt: ConvertOptions, src: str, dest: str | None = None,
+            image_stats: ImageStats | None = None,
+            cache: ResultCache | None = None,
+            stats: PipelineStats | None = None,
+            progress: Progress | None = None) -> Any:
+    """Convert a PDF file, reusing a cached result for the same file and
+    options if a cache is given."""
+
+    # Before hashing the file, which takes a while for a large one
+    if progress is not None:
+        progress.event('start', force=True)
+    if cache is not None:
+        key = cache.key(asdict(opt), src)
+        epub = cache.get(key, dest)
+        if epub is not None:
+            if progress is not None:
+                progress.event('done', force=True, cached=True)
+            return epub
+    with open_pdf(opt)(src) as session:
+        epub = convert_session(opt, session, dest, image_stats, stats,
+                               progress)
+    if cache is not None:
+        cache.put(key, epub)
     return epub
 
 
@@ -716,33 +1182,108 @@ def convert(opt: ConvertOptions, src: str) -> Any:
 
 if __name__ == '__main__':
     import argparse
-    import os
-    import shutil
 
     parser = argparse.ArgumentParser(description='Process a PDF document.')
     parser.add_argument('file', nargs='?', type=str)
     parser.add_argument('--vertical', nargs='?', const=True, default=False)
     parser.add_argument('--name', type=str)
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of processes used to extract pages')
+    parser.add_argument('--stream-window', type=int, default=0,
+                        help='aggregate paragraphs this many pages at a time '
+                             'to bound memory (0 reads the whole document)')
+    parser.add_argument('--image-dpi', type=int, default=0,
+                        help='downsample images to this resolution of their '
+                             'displayed size and recompress them (0 keeps '
+                             'images as they are)')
+    parser.add_argument('--image-quality', type=int, default=80,
+                        help='JPEG quality of recompressed images')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of documents converted concurrently '
+                             'in batch mode, or worker processes in server '
+                             'mode')
+    parser.add_argument('--cache-dir', type=str,
+                        help='reuse results of previous conversions stored '
+                             'in this directory')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help='size limit of the result cache, in megabytes')
+    parser.add_argument('--low-memory', action='store_true',
+                        help='bound memory used per page, for very large '
+                             'documents, at some cost in speed')
+    parser.add_argument('--page-cache', type=str,
+                        help='cache the text and images extracted from each '
+                             'page in this directory, so converting a '
+                             'document again with other options skips '
+                             'parsing it')
+    parser.add_argument('--lazy-images', action='store_true',
+                        help='only locate images while extracting text and '
+                             'read them when they are written')
+    parser.add_argument('--no-images', action='store_true',
+                        help='leave images out')
+    parser.add_argument('--stats-log', type=str,
+                        help='append timing and counters of every stage of '
+                             'each conversion to this file as a line of '
+                             'JSON (- for stderr)')
+    parser.add_argument('--progress', action='store_true',
+                        help='report progress as lines of JSON on stderr')
+    parser.add_argument('--serve', action='store_true',
+                        help='run as a server reading JSON jobs from stdin '
+                             '(or --socket)')
+    parser.add_argument('--socket', type=str,
+                        help='path of a Unix socket to serve jobs on')
     args = parser.parse_args()
     pdf = args.file
     opt = ConvertOptions(
-        vertical=args.vertical
+        vertical=args.vertical,
+        jobs=args.jobs,
+        stream_window=args.stream_window,
+        image_dpi=args.image_dpi,
+        image_quality=args.image_quality,
+        page_cache=args.page_cache,
+        low_memory=args.low_memory,
+        images='none' if args.no_images
+        else 'lazy' if args.lazy_images else 'eager'
     )
-    if pdf is None:
-        for root, dirs, files in os.walk('/app/pdf', topdown=False):
-            for name in files:
-                pn, ext = os.path.splitext(name)
-                if ext == '.pdf':
-                    full_path = os.path.join(root, name)
-                    epub = convert(opt, full_path)
-                    epub_path = os.path.join(root, pn + '.epub')
-                    shutil.move(epub, epub_path)
-                    print(epub_path)
+    cache = None
+    if args.cache_dir is not None:
+        cache = open_cache(args.cache_dir, args.cache_size * 1024 * 1024)
+    if args.serve:
+        import server
+
+        server.serve(args.workers, args.socket, cache, args.stats_log)
+    elif pdf is None:
+        import time
+        import batch
+
+        start = time.perf_counter()
+        results = []
+        pdfs = batch.find_pdfs('/app/pdf')
+        for result in batch.convert_batch(opt, pdfs, args.workers, cache,
+                                          args.stats_log):
+            if result.status == 'ok':
+                print(result.epub, flush=True)
+            results.append(result)
+        print(batch.summarize(results, time.perf_counter() - start))
     else:
         real_pdf = os.path.join('/app/pdf', pdf)
         pn, ext = os.path.splitext(real_pdf)
-        epub = convert(opt, real_pdf)
         name = args.name if args.name is not None else pn
         epub_path = os.path.join('/app/pdf', name + '.epub')
-        shutil.move(epub, epub_path)
+        image_stats = ImageStats()
+        stats = PipelineStats() if args.stats_log is not None else None
+        progress = Progress(print_event) if args.progress else None
+        convert(opt, real_pdf, epub_path, image_stats, cache, stats,
+                progress)
         print(epub_path)
+        if stats is not None:
+            log_stats(args.stats_log,
+                      {'file': real_pdf, 'epub': epub_path, **stats.as_dict()})
+        import sys
+
+        if cache is not None:
+            print('cache: %s' % ('hit' if cache.hits > 0 else 'miss',),
+                  file=sys.stderr)
+        if opt.image_dpi > 0:
+            print('images: %d, recompressed: %d, bytes saved: %d'
+                  % (image_stats.count, image_stats.recompressed,
+                     image_stats.bytes_saved), file=sys.stderr)
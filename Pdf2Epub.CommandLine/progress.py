@@ -0,0 +1,46 @@
+from typing import Any, Callable, Iterator
+import json
+import sys
+import time
+
+from line import Line
+
+
+class Progress:
+    """Progress events of a conversion, passed to `emit` as dicts like
+
+        {"stage": "extract", "page": 512, "pages": 2000}
+
+    Events are rate-limited to one per `interval` seconds, except for the
+    first and the last one, which are always emitted."""
+
+    def __init__(self, emit: Callable[[dict[str, Any]], None],
+                 interval: float = 0.5):
+        self.emit = emit
+        self.interval = interval
+        self.last = float('-inf')
+
+    def event(self, stage: str, force: bool = False, **fields: Any) -> None:
+        now = time.monotonic()
+        if force or now - self.last >= self.interval:
+            self.last = now
+            self.emit({'stage': stage, **fields})
+
+    def pages(self, stage: str, lines: Iterator[Line], pages: int) \
+            -> Iterator[Line]:
+        """Pass a stream of lines through, reporting the page a stage is
+        working on. The clock is only read when a new page starts."""
+
+        page = -1
+        for line in lines:
+            if line.page != page:
+                page = line.page
+                self.event(stage, page=page + 1, pages=pages)
+            yield line
+
+
+def print_event(event: dict[str, Any]) -> None:
+    """Write an event to stderr as a line of JSON."""
+
+    sys.stderr.write(json.dumps(event) + '\n')
+    sys.stderr.flush()
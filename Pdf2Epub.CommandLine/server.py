@@ -0,0 +1,253 @@
+from typing import Any, Callable, TextIO
+import contextlib
+import gc
+import io
+import itertools
+import json
+import multiprocessing.pool
+import os
+import socketserver
+import sys
+import threading
+import time
+
+from main import ConvertOptions, convert, is_english_word
+from cache import ResultCache
+from instrument import PipelineStats, log_stats
+from progress import Progress
+import epubgen
+import textclass
+import utils
+
+PDF_ROOT = '/app/pdf'
+
+# Result cache shared by the workers, and the file every job's stage
+# timing is logged to; set before workers are forked
+cache_: ResultCache | None = None
+stats_log_: str | None = None
+# Progress events of jobs are sent from workers to the server through this
+# queue, tagged with a key that tells which connection to write them to;
+# the response of such a job is sent last through the same queue, so that
+# it's written after every event of the job
+events_: 'multiprocessing.SimpleQueue | None' = None
+# Function writing to the connection of each key, and an event set once
+# the response has been written
+listeners_: dict[int, tuple[Callable[[dict[str, Any]], None],
+                            threading.Event]] = {}
+listener_keys_ = itertools.count()
+
+
+def handle_job(job: dict[str, Any], key: int | None = None) \
+        -> dict[str, Any]:
+    """Run a conversion job. Never raises; errors are reported in the
+    response. With a listener `key`, progress events and then the response
+    are sent to it."""
+
+    start = time.perf_counter()
+    response = {'id': job.get('id'), 'status': 'ok'}
+    try:
+        # Jobs already run in parallel, so unless asked otherwise a job
+        # recompresses its images in its own process
+        opt = ConvertOptions(**{'vertical': False, 'image_workers': 1,
+                                **job.get('options', {})})
+        src = os.path.join(PDF_ROOT, job['file'])
+        pn, ext = os.path.splitext(src)
+        name = job.get('name') or pn
+        epub_path = os.path.join(PDF_ROOT, name + '.epub')
+        hits = cache_.hits if cache_ is not None else 0
+        stats = None
+        if job.get('stats') or stats_log_ is not None:
+            stats = PipelineStats()
+        progress = None
+        if key is not None:
+            progress = Progress(
+                lambda event: events_.put((key, {'id': job.get('id'),
+                                                 **event}, False)))
+        convert(opt, src, epub_path, cache=cache_, stats=stats,
+                progress=progress)
+        response['epub'] = epub_path
+        if cache_ is not None:
+            response['cached'] = cache_.hits > hits
+        if job.get('stats'):
+            response['stats'] = stats.as_dict()
+        if stats_log_ is not None:
+            log_stats(stats_log_, {'id': job.get('id'), 'file': src,
+                                   'epub': epub_path, **stats.as_dict()})
+    except Exception as e:
+        response['status'] = 'error'
+        response['error'] = '%s: %s' % (type(e).__name__, e)
+    response['seconds'] = round(time.perf_counter() - start, 3)
+    if key is not None:
+        events_.put((key, response, True))
+    return response
+
+
+def parse_job(line: str) -> dict[str, Any] | None:
+    """Parse a line of input into a job, or None if it's blank; raise
+    ValueError if it isn't a JSON object."""
+
+    line = line.strip()
+    if len(line) == 0:
+        return None
+    job = json.loads(line)
+    if not isinstance(job, dict):
+        raise ValueError('a job must be a JSON object, not %s'
+                         % type(job).__name__)
+    return job
+
+
+def warm_up() -> None:
+    """Load everything a conversion needs before workers are forked."""
+
+    # Modules imported lazily would otherwise be imported by every worker;
+    # PyMuPDF prints a deprecation warning then, which mustn't end up among
+    # responses on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        utils.lazy_import('fitz').TOOLS
+        utils.lazy_import('numpy').zeros(1)
+    is_english_word('warm')
+    # Builds the character class table
+    textclass.char_class(' ')
+    epubgen.load_template()
+    # Objects that exist now are never freed by workers; keep the collector
+    # from touching (and thus un-sharing) their pages.
+    gc.freeze()
+
+
+def make_pool(workers: int) -> multiprocessing.pool.Pool:
+    """Pre-fork worker processes that inherit the warm server state,
+    including the queue of progress events.
+
+    Workers aren't daemonic, so that jobs can start process pools of their
+    own (to extract pages or recompress images); the pool still terminates
+    them when it's closed."""
+
+    global events_
+
+    methods = multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context('fork' if 'fork' in methods else None)
+
+    class Process(ctx.Process):
+        @property
+        def daemon(self) -> bool:
+            return False
+
+        @daemon.setter
+        def daemon(self, value: bool) -> None:
+            pass
+
+    class Context(type(ctx)):
+        pass
+
+    Context.Process = Process
+    events_ = ctx.SimpleQueue()
+    threading.Thread(target=relay_events, args=(events_,),
+                     daemon=True).start()
+    return multiprocessing.pool.Pool(processes=workers, context=Context())
+
+
+def relay_events(events: 'multiprocessing.SimpleQueue') -> None:
+    """Write progress events and responses from workers to the connections
+    their jobs came from."""
+
+    while True:
+        key, message, final = events.get()
+        listener = listeners_.pop(key, None) if final else listeners_.get(key)
+        if listener is not None:
+            respond, answered = listener
+            respond(message)
+            if final:
+                answered.set()
+
+
+def serve_stream(pool: multiprocessing.pool.Pool,
+                 fin: TextIO, fout: TextIO) -> None:
+    """Serve jobs read from a text stream, writing responses as soon as
+    each job is finished (not necessarily in order)."""
+
+    lock = threading.Lock()
+
+    def respond(response: dict[str, Any]) -> None:
+        with lock:
+            fout.write(json.dumps(response, ensure_ascii=False) + '\n')
+            fout.flush()
+
+    pending = []
+    answered = []
+    for line in fin:
+        try:
+            job = parse_job(line)
+        except ValueError as e:
+            respond({'id': None, 'status': 'error', 'error': str(e)})
+            continue
+        if job is None:
+            continue
+        key = None
+        callback = respond
+        if job.get('progress'):
+            # The response comes after the progress events, through the
+            # relay thread
+            key = next(listener_keys_)
+            listeners_[key] = (respond, threading.Event())
+            answered.append(listeners_[key][1])
+            callback = None
+        pending.append(pool.apply_async(handle_job, (job, key),
+                                        callback=callback))
+    for result in pending:
+        result.wait()
+    for event in answered:
+        event.wait()
+
+
+def serve_socket(pool: multiprocessing.pool.Pool, path: str) -> None:
+    """Serve jobs from connections to a Unix socket."""
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self) -> None:
+            fin = io.TextIOWrapper(self.rfile, encoding='utf-8')
+            fout = io.TextIOWrapper(self.wfile, encoding='utf-8')
+            serve_stream(pool, fin, fout)
+
+    if os.path.exists(path):
+        os.unlink(path)
+    with socketserver.ThreadingUnixStreamServer(path, Handler) as server:
+        server.serve_forever()
+
+
+def serve(workers: int, socket_path: str | None = None,
+          cache: ResultCache | None = None,
+          stats_log: str | None = None) -> None:
+    """Warm up, pre-fork `workers` processes and serve jobs until the input
+    is closed (stdin) or the server is killed (socket).
+
+    Jobs are JSON objects, one per line, e.g.
+
+        {"id": "42", "file": "42.pdf", "name": "book", "options": {}}
+
+    where `file` and `name` mean the same as on the command line,
+    `options` are fields of `ConvertOptions` and an optional `"stats": true`
+    asks for the timing and counters of every stage. For every job a line
+    like
+
+        {"id": "42", "status": "ok", "epub": "/app/pdf/book.epub", ...}
+
+    is written back to stdout or to the connection the job came from (with
+    a result cache, responses also tell whether the result was `cached`).
+    Jobs with `"progress": true` also get a few lines like
+
+        {"id": "42", "stage": "extract", "page": 512, "pages": 2000}
+
+    before the response, starting as soon as a worker picks the job up.
+    Since the modules and the word list are loaded before workers are
+    forked, workers share them copy-on-write and no job pays for startup."""
+
+    global cache_, stats_log_
+
+    cache_ = cache
+    stats_log_ = stats_log
+    warm_up()
+    with make_pool(workers) as pool:
+        if socket_path is None:
+            serve_stream(pool, sys.stdin, sys.stdout)
+        else:
+            serve_socket(pool, socket_path)
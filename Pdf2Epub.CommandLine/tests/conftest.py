@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def make_pdf(tmp_path):
+    """Write a PDF whose pages are drawn by the given functions, each called
+    with a new page."""
+
+    import fitz
+
+    def make(*draws, name: str = 'doc.pdf') -> str:
+        doc = fitz.open()
+        for draw in draws:
+            draw(doc.new_page())
+        path = str(tmp_path / name)
+        doc.save(path)
+        return path
+
+    return make
@@ -0,0 +1,37 @@
+import zipfile
+
+import main
+
+
+def epub_text(path: str) -> str:
+    with zipfile.ZipFile(path) as z:
+        return ''.join(z.read(name).decode() for name in z.namelist()
+                       if name.endswith('.html'))
+
+
+def test_text_running_off_the_page(make_pdf, tmp_path):
+    def draw(page):
+        page.insert_text((-4, 100), 'A line starting left of the page')
+        for y in range(120, 400, 14):
+            page.insert_text((72, y), 'Body text of the page, line %d' % y)
+
+    dest = str(tmp_path / 'out.epub')
+    main.convert(main.ConvertOptions(vertical=False), make_pdf(draw), dest)
+    text = epub_text(dest)
+    assert 'starting left of the page' in text
+    assert 'line 386' in text
+
+
+def test_no_space_is_added_after_a_url():
+    # As before, a URL anywhere in the paragraph keeps spaces out
+    assert main.fix_whitespace('see http://example.com/a', 'b') == 'b'
+    assert main.fix_whitespace('http://example.com and\tmore', ' text') \
+        == 'text'
+    assert main.fix_whitespace('no link here', ' text') == ' text'
+
+
+def test_words_with_ligatures_are_dehyphenated():
+    assert main.merge_texts('the deﬁ-', 'nition of', line_break=True) \
+        == 'the deﬁnition of'
+    assert main.merge_texts('a ﬂoat-', 'ing point', line_break=True) \
+        == 'a ﬂoating point'
@@ -0,0 +1,38 @@
+import os
+
+import batch
+import main
+
+
+def draw_text(page):
+    page.insert_text((72, 72), 'Body text of the page')
+
+
+def test_concurrent_documents_recompress_images_inline(make_pdf,
+                                                       monkeypatch):
+    def convert_session(opt, *args):
+        raise RuntimeError(opt.image_workers)
+
+    monkeypatch.setattr(batch, 'convert_session', convert_session)
+    srcs = [make_pdf(draw_text, name='%d.pdf' % i) for i in range(2)]
+    opt = main.ConvertOptions(vertical=False, image_workers=8)
+    results = list(batch.convert_batch(opt, srcs, 2))
+    assert [r.error for r in results] == ['RuntimeError: 1'] * 2
+
+
+def test_worker_crashing_fails_only_its_document(make_pdf, monkeypatch):
+    def convert_session(opt, session, dest, *args):
+        if os.path.basename(dest) == 'crash.epub':
+            os._exit(1)
+        with open(dest, 'w') as f:
+            f.write('epub')
+
+    monkeypatch.setattr(batch, 'convert_session', convert_session)
+    names = ['crash'] + ['%d' % i for i in range(5)]
+    srcs = [make_pdf(draw_text, name=name + '.pdf') for name in names]
+    opt = main.ConvertOptions(vertical=False)
+    results = {os.path.basename(r.src): r
+               for r in batch.convert_batch(opt, srcs, 2)}
+    assert len(results) == len(srcs)
+    assert results.pop('crash.pdf').status == 'error'
+    assert all(r.status == 'ok' for r in results.values())
@@ -0,0 +1,41 @@
+import os
+import tempfile
+
+from cache import ResultCache
+import main
+
+
+def test_misses_leave_no_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path / 'tmp'))
+    os.makedirs(tempfile.tempdir)
+    cache = ResultCache(str(tmp_path / 'cache'), 1 << 20, 'test')
+    assert cache.get('0' * 64) is None
+    assert os.listdir(tempfile.tempdir) == []
+
+
+def test_results_round_trip(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), 1 << 20, 'test')
+    src = tmp_path / 'result.epub'
+    src.write_bytes(b'epub data')
+    cache.put('ab' * 32, str(src))
+    assert os.listdir(tmp_path / 'cache' / 'ab') == ['ab' * 32 + '.epub']
+    dest = cache.get('ab' * 32)
+    with open(dest, 'rb') as f:
+        assert f.read() == b'epub data'
+    os.remove(dest)
+
+
+def test_page_cache_is_trimmed_after_extraction(make_pdf, tmp_path):
+    def draw(page):
+        for y in range(72, 700, 14):
+            page.insert_text((72, y), 'Body text of the page, line %d' % y)
+
+    root = tmp_path / 'pages'
+    opt = main.ConvertOptions(vertical=False, page_cache=str(root),
+                              page_cache_size=8192)
+    main.convert(opt, make_pdf(*[draw] * 10, name='a.pdf'),
+                 str(tmp_path / 'a.epub'))
+    main.convert(opt, make_pdf(*[draw] * 9, name='b.pdf'),
+                 str(tmp_path / 'b.epub'))
+    sizes = [entry.stat().st_size for entry in root.glob('*/*/*.bin')]
+    assert 0 < sum(sizes) <= 8192
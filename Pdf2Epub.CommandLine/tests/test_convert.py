@@ -0,0 +1,85 @@
+import random
+
+import fitz
+
+import main
+from cache import ResultCache
+from document import Session
+from instrument import PipelineStats
+from progress import Progress
+
+
+def draw_chapter(page):
+    page.insert_text((72, 72), 'A heading', fontsize=20)
+    for y in range(100, 400, 14):
+        page.insert_text((72, y), 'Body text of the page, line %d' % y)
+
+
+def test_heading_size_given_skips_the_pre_pass(make_pdf):
+    with Session(make_pdf(draw_chapter)) as session:
+        opt = main.resolve_options(
+            main.ConvertOptions(vertical=False, heading_size=15), session)
+        assert opt.heading_size == 15
+        assert session.statistics is None
+        assert len(session.sampled_lines) == 0
+
+
+def test_pre_pass_is_metered_after_start(make_pdf, tmp_path):
+    events = []
+    stats = PipelineStats()
+
+    def emit(event):
+        events.append((event['stage'], [s.name for s in stats.stages]))
+
+    main.convert(main.ConvertOptions(vertical=False),
+                 make_pdf(draw_chapter), str(tmp_path / 'out.epub'),
+                 stats=stats, progress=Progress(emit))
+    assert events[:2] == [('start', []), ('analyze', [])]
+    names = [stage.name for stage in stats.stages]
+    assert names[:2] == ['analyze_document', 'extract_rawlines']
+    assert stats.document['pages_sampled'] == 1
+
+
+def test_cache_hits_are_done(make_pdf, tmp_path):
+    src = make_pdf(draw_chapter)
+    cache = ResultCache(str(tmp_path / 'cache'), 1 << 20, 'test')
+    opt = main.ConvertOptions(vertical=False)
+    for name in ('a.epub', 'b.epub'):
+        events = []
+        main.convert(opt, src, str(tmp_path / name), cache=cache,
+                     progress=Progress(events.append))
+    assert cache.hits == 1
+    assert events == [{'stage': 'start'},
+                      {'stage': 'done', 'cached': True}]
+
+
+def test_sampled_images_are_spilled_in_low_memory_mode(make_pdf):
+    def draw(page):
+        page.insert_text((72, 72), 'A page with a photo')
+        # Noise, so that the image is too large to keep in memory
+        samples = random.Random(0).randbytes(300 * 300 * 3)
+        pix = fitz.Pixmap(fitz.csRGB, 300, 300, samples, False)
+        page.insert_image(fitz.Rect(72, 100, 372, 400),
+                          stream=pix.tobytes('png'))
+
+    with Session(make_pdf(draw)) as session:
+        main.analyze_document(
+            main.ConvertOptions(vertical=False, low_memory=True), session)
+        images = [line for lines in session.sampled_lines.values()
+                  for line in lines if line.type == main.LineType.IMAGE]
+        assert len(images) == 1
+        assert not isinstance(images[0].data, bytes)
+
+
+def test_styles_are_interned_per_conversion(make_pdf, tmp_path):
+    import line
+
+    opt = main.ConvertOptions(vertical=False)
+    for size in range(8, 14):
+        def draw(page):
+            page.insert_text((72, 72), 'Text in %d points' % size,
+                             fontsize=size)
+
+        main.convert(opt, make_pdf(draw, name='%d.pdf' % size),
+                     str(tmp_path / ('%d.epub' % size)))
+        assert {style[0] for style in line.styles_} == {size}
@@ -0,0 +1,55 @@
+import io
+import zipfile
+
+import fitz
+
+import epubgen
+import main
+
+
+def test_images_of_an_open_chapter_are_spilled():
+    buf = io.BytesIO()
+    with epubgen.EpubWriter(buf, 'Book') as writer:
+        writer.write('<p>text</p>')
+        hrefs = [writer.add_image(bytes([i]) * 1000, 'png') for i in range(3)]
+        assert all(not isinstance(data, bytes)
+                   for _, data in writer.pending)
+    with zipfile.ZipFile(buf) as z:
+        for i, href in enumerate(hrefs):
+            assert z.read('OEBPS/' + href) == bytes([i]) * 1000
+
+
+def test_long_chapters_of_a_toc_are_split(make_pdf, tmp_path):
+    def draw(page):
+        for y in range(72, 700, 14):
+            page.insert_text((72, y), 'Body text of the page, line %d' % y)
+
+    src = make_pdf(*[draw] * 10)
+    with fitz.open(src) as doc:
+        doc.set_toc([[1, 'The only chapter', 1]])
+        doc.saveIncr()
+    dest = str(tmp_path / 'out.epub')
+    main.convert(main.ConvertOptions(vertical=False, chapter_size=4096),
+                 src, dest)
+    with zipfile.ZipFile(dest) as z:
+        titled = [name for name in z.namelist()
+                  if name.startswith('OEBPS/page-')
+                  and b'<title>The only chapter</title>' in z.read(name)]
+        assert len(titled) > 1
+
+
+def test_spans_looking_like_their_paragraph_are_not_wrapped(make_pdf,
+                                                            tmp_path):
+    def draw(page):
+        page.insert_text((72, 100), 'Body text set in ten points,',
+                         fontsize=10)
+        page.insert_text((250, 100), 'and a bit in eleven', fontsize=11)
+
+    dest = str(tmp_path / 'out.epub')
+    main.convert(main.ConvertOptions(vertical=False, heading_size=30),
+                 make_pdf(draw), dest)
+    with zipfile.ZipFile(dest) as z:
+        html = b''.join(z.read(name) for name in z.namelist()
+                        if name.startswith('OEBPS/page-'))
+    assert b'eleven' in html
+    assert b'<span' not in html
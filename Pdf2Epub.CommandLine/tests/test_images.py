@@ -0,0 +1,39 @@
+import concurrent.futures
+
+import fitz
+
+import images
+from line import ImageLine
+
+
+def make_png(colors: list[tuple], width: int = 40, height: int = 30) -> bytes:
+    """A lossless image made of vertical stripes of the given colors."""
+
+    pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, width, height), False)
+    stripe = width // len(colors)
+    for i, color in enumerate(colors):
+        pix.set_rect(fitz.IRect(i * stripe, 0, width, height), color)
+    return pix.tobytes('png')
+
+
+def test_palette_png_is_lossless():
+    data = make_png([(255, 255, 255), (0, 0, 0), (200, 30, 30)])
+    pix = fitz.Pixmap(data)
+    palette = images.palette_png(pix)
+    assert palette is not None
+    assert fitz.Pixmap(palette).samples == pix.samples
+
+
+def test_few_images_are_recompressed_inline(monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError('a process pool was started')
+
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor', no_pool)
+    line = ImageLine((0, 0, 40, 30), 0, 'png', 40, 30,
+                     make_png([(255, 255, 255), (0, 0, 255)]))
+    size_in = len(line.image)
+    stats = images.ImageStats()
+    lines = list(images.process_images(96, 75, 4, iter([line]), stats))
+    assert lines == [line]
+    assert stats.recompressed == 1
+    assert len(line.image) < size_in
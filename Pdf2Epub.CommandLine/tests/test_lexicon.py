@@ -0,0 +1,17 @@
+from lexicon import Lexicon, WordLookup
+
+
+def test_inflections_are_replaced_anywhere():
+    words = WordLookup(Lexicon())
+    assert 'abbess' in words
+    assert 'abbesses' in words
+    # Like str.replace, not only at the end of the word
+    assert 'abbingss' in words
+    assert 'xqzvkjw' not in words
+
+
+def test_memoized_answers_are_the_same():
+    words = WordLookup(Lexicon(), memo_size=2)
+    queries = ['abbess', 'abbingss', 'xqzvkjw', 'abbess', 'xqzvkjw', 'abbingss']
+    assert [q in words for q in queries] == [True, True, False, True, False, True]
+    assert words.hits + words.misses == len(queries)
@@ -0,0 +1,80 @@
+import io
+import json
+import time
+
+import fitz
+
+import server
+
+
+def draw_photo(page):
+    page.insert_text((72, 72), 'A page with a photo')
+    pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 400, 300), False)
+    pix.set_rect(pix.irect, (200, 120, 40))
+    page.insert_image(fitz.Rect(72, 100, 472, 400), pixmap=pix)
+
+
+def draw_text(page):
+    for y in range(72, 700, 14):
+        page.insert_text((72, y), 'Body text of the page, line %d' % y)
+
+
+def serve_lines(jobs: list, workers: int = 1) -> list[dict]:
+    fin = io.StringIO(''.join(json.dumps(job) + '\n' for job in jobs))
+    fout = io.StringIO()
+    with server.make_pool(workers) as pool:
+        server.serve_stream(pool, fin, fout)
+    return [json.loads(line) for line in fout.getvalue().splitlines()]
+
+
+def serve_jobs(jobs: list[dict]) -> dict:
+    return {response['id']: response for response in serve_lines(jobs)}
+
+
+def test_jobs_starting_process_pools(make_pdf, tmp_path):
+    photos = make_pdf(*[draw_photo] * 3, name='photos.pdf')
+    book = make_pdf(*[draw_text] * 40, name='book.pdf')
+    responses = serve_jobs([
+        {'id': 'images', 'file': photos, 'name': str(tmp_path / 'a'),
+         'options': {'image_dpi': 30, 'image_workers': 2}},
+        {'id': 'pages', 'file': book, 'name': str(tmp_path / 'b'),
+         'options': {'jobs': 2}},
+    ])
+    for response in responses.values():
+        assert response['status'] == 'ok', response.get('error')
+
+
+def test_progress_events_come_before_responses(make_pdf, tmp_path,
+                                              monkeypatch):
+    relay = server.relay_events
+
+    class SlowQueue:
+        """Delays events, as a busy relay thread would."""
+
+        def __init__(self, events):
+            self.events = events
+
+        def get(self):
+            time.sleep(0.02)
+            return self.events.get()
+
+    monkeypatch.setattr(server, 'relay_events',
+                        lambda events: relay(SlowQueue(events)))
+    book = make_pdf(*[draw_text] * 4, name='book.pdf')
+    jobs = [{'id': str(i), 'file': book, 'name': str(tmp_path / str(i)),
+             'progress': True} for i in range(8)]
+    lines = serve_lines(jobs, workers=2)
+    for job in jobs:
+        stages = [line.get('stage', 'response') for line in lines
+                  if line['id'] == job['id']]
+        assert stages[0] == 'start'
+        assert stages[-2:] == ['done', 'response']
+
+
+def test_jobs_that_are_not_objects_are_errors(make_pdf, tmp_path):
+    book = make_pdf(draw_text, name='book.pdf')
+    lines = serve_lines([[1], 'x', 3,
+                         {'id': 'book', 'file': book,
+                          'name': str(tmp_path / 'book')}])
+    assert [line['id'] for line in lines] == [None] * 3 + ['book']
+    assert [line['status'] for line in lines] == ['error'] * 3 + ['ok']
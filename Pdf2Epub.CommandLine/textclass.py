@@ -0,0 +1,85 @@
+import unicodedata
+
+# Bits of the class of a character
+WIDE = 1  # East Asian full-width, wide or ambiguous: no space around it
+SPACE = 2
+EOS = 4  # May end a sentence
+CONTROL = 8  # Invalid in XML
+CJK = 16  # Han ideograph
+
+EOS_CHARS = '。.！!？?”"…'
+CONTROL_CHARS = ''.join(map(chr, range(32))) + '\x7f'
+# CJK Unified Ideographs, Extension A and Compatibility Ideographs
+CJK_RANGES = ((0x3400, 0x4dbf), (0x4e00, 0x9fff), (0xf900, 0xfaff))
+
+
+def classify(ch: str) -> int:
+    """Compute the class of a character."""
+
+    c = ord(ch)
+    cls = 0
+    if unicodedata.east_asian_width(ch) in ('F', 'W', 'A'):
+        cls |= WIDE
+    if ch.isspace():
+        cls |= SPACE
+    if ch in EOS_CHARS:
+        cls |= EOS
+    if ch in CONTROL_CHARS:
+        cls |= CONTROL
+    if any(lo <= c <= hi for lo, hi in CJK_RANGES):
+        cls |= CJK
+    return cls
+
+
+def build_table() -> bytes:
+    """Classes of every character of the Basic Multilingual Plane.
+
+    Only width and whitespace need to be computed for each character; the
+    other classes are small sets or ranges, marked afterwards."""
+
+    eaw = unicodedata.east_asian_width
+    table = bytearray((eaw(ch) in ('F', 'W', 'A')) * WIDE
+                      | ch.isspace() * SPACE
+                      for ch in map(chr, range(0x10000)))
+    for ch in EOS_CHARS:
+        table[ord(ch)] |= EOS
+    for ch in CONTROL_CHARS:
+        table[ord(ch)] |= CONTROL
+    for lo, hi in CJK_RANGES:
+        table[lo:hi + 1] = bytes(c | CJK for c in table[lo:hi + 1])
+    return bytes(table)
+
+
+# Built on first use rather than on import, since it takes a few tens of
+# milliseconds
+table_: bytes | None = None
+
+
+def char_class(ch: str) -> int:
+    """The class of a character, looked up in a table for the BMP."""
+
+    global table_
+    c = ord(ch)
+    if c >= 0x10000:
+        return classify(ch)
+    if table_ is None:
+        table_ = build_table()
+    return table_[c]
+
+
+def last_nonspace(text: str) -> int:
+    """Index of the last character of a text that isn't whitespace, or -1.
+
+    Unlike `rstrip`, this doesn't copy the text, which matters when it's a
+    paragraph growing line by line."""
+
+    i = len(text) - 1
+    while i >= 0 and char_class(text[i]) & SPACE:
+        i -= 1
+    return i
+
+
+def has_cjk(text: str) -> bool:
+    """Whether a text has any Han ideograph."""
+
+    return any(char_class(ch) & CJK for ch in text)
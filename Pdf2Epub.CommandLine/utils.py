@@ -1,19 +1,39 @@
 from typing import Any, Callable, Iterable, Iterator, TypeVar
 from contextlib import contextmanager
-import numpy as np
+import functools
+import importlib.util
 import os
-import tempfile
-import subprocess
+import sys
 import math
 
 T = TypeVar('T')
 U = TypeVar('U')
 
 
+def lazy_import(name: str) -> Any:
+    """Import a module on first attribute access rather than right away,
+    so that heavy dependencies don't add to startup time until used."""
+
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+np = lazy_import('numpy')
+
+
 def curry_first_arg(fn):
     """Perform function currying on the first (positional) argument."""
 
-    return lambda arg: lambda *args, **kwargs: fn(arg, *args, **kwargs)
+    # Keep the name of the function, e.g. for instrumentation
+    return functools.wraps(fn)(
+        lambda arg: lambda *args, **kwargs: fn(arg, *args, **kwargs))
 
 
 def split_on(pred, elements):
@@ -25,12 +45,6 @@ def split_on(pred, elements):
     return t, f
 
 
-def filter_dict_by(props: list[str], dic: dict[str, Any]) -> dict[str, Any]:
-    """Only retains specified properties of a dict."""
-
-    return {p: dic[p] for p in props}
-
-
 @contextmanager
 def push_dir(path: str) -> Iterator[None]:
     """A simulation of `pushdir` and `popdir` command."""
@@ -46,6 +60,8 @@ def push_dir(path: str) -> Iterator[None]:
 def make_file_temp(src: str) -> str:
     """Moves a file to a temporary path."""
 
+    import tempfile
+
     path_dest = tempfile.mkdtemp()
     _, fname = os.path.split(src)
     dest = os.path.join(path_dest, fname)
@@ -56,6 +72,8 @@ def make_file_temp(src: str) -> str:
 def latex_to_pdf(src: str) -> str:
     """Compiles a LaTeX source file to PDF."""
 
+    import subprocess
+
     path_src, fname = os.path.split(src)
     fname_pdf = os.path.splitext(fname)[0] + '.pdf'
     with push_dir(path_src):
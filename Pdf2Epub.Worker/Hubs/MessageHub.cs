@@ -1,6 +1,7 @@
 ﻿using Microsoft.AspNetCore.SignalR.Client;
 using System.Diagnostics;
 using System.Net;
+using System.Text.Json;
 
 namespace Pdf2Epub.Worker.Hubs
 {
@@ -10,6 +11,7 @@ namespace Pdf2Epub.Worker.Hubs
         private readonly HubConnection connection_;
         private readonly HttpClient client_;
         private readonly Guid id_;
+        private readonly Process converter_;
 
         public MessageHub()
         {
@@ -18,6 +20,10 @@ namespace Pdf2Epub.Worker.Hubs
 
             client_ = new HttpClient();
 
+            // A long-lived conversion server keeps the Python interpreter and
+            // its imports warm, so tasks don't pay for startup every time.
+            converter_ = StartConverter();
+
             id_ =  Guid.Parse(client_.PostAsync($"{api_url_}/worker", null).Result.Content.ReadAsStringAsync().Result);
 
             connection_ = new HubConnectionBuilder().WithUrl($"{api_url_}/hub").Build();
@@ -40,30 +46,47 @@ namespace Pdf2Epub.Worker.Hubs
                         }
                     }
 
-                    var process = new Process() {
-                        StartInfo = new ProcessStartInfo() {
-                            FileName = "python",
-                            Arguments = $"main.py {file_id}.pdf",
-                            UseShellExecute = false,
-                        }
-                    };
-
-                    var callback_output = new DataReceivedEventHandler(
-                        (_, e) => {
-                            if (!string.IsNullOrEmpty(e.Data))
-                            {
-                                Console.WriteLine(e.Data);
-                            }
-                        }
-                    );
+                    var job = JsonSerializer.Serialize(new {
+                        id = task_id,
+                        file = $"{file_id}.pdf",
+                        // Ask for progress lines before the final response
+                        progress = true,
+                    });
+                    lock (converter_)
+                    {
+                        converter_.StandardInput.WriteLine(job);
+                        converter_.StandardInput.Flush();
+                    }
+                }
+            );
+        }
 
-                    process.StartInfo.RedirectStandardOutput = true;
-                    process.OutputDataReceived += callback_output;
+        private static Process StartConverter()
+        {
+            var process = new Process() {
+                StartInfo = new ProcessStartInfo() {
+                    FileName = "python",
+                    Arguments = "main.py --serve",
+                    UseShellExecute = false,
+                }
+            };
 
-                    process.Start();
-                    process.BeginOutputReadLine();
+            var callback_output = new DataReceivedEventHandler(
+                (_, e) => {
+                    if (!string.IsNullOrEmpty(e.Data))
+                    {
+                        Console.WriteLine(e.Data);
+                    }
                 }
             );
+
+            process.StartInfo.RedirectStandardInput = true;
+            process.StartInfo.RedirectStandardOutput = true;
+            process.OutputDataReceived += callback_output;
+
+            process.Start();
+            process.BeginOutputReadLine();
+            return process;
         }
     }
 }
@@ -0,0 +1,61 @@
+"""Saving benchmark results as baselines and comparing later runs to them,
+shared by the bench_* scripts.
+
+A benchmark describes its result as named measurements (e.g. pages/s of a
+stage on a corpus); a measurement regresses if it's worse than the
+baseline's by more than a tolerance."""
+
+from typing import Any, Callable
+import argparse
+import json
+import sys
+
+Measure = Callable[[dict[str, Any]], dict[str, float]]
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--save', type=str,
+                        help='save the result as a baseline')
+    parser.add_argument('--baseline', type=str,
+                        help='compare against a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+
+
+def regressions(result: dict[str, Any], baseline: dict[str, Any],
+                measure: Measure, tolerance: float, unit: str,
+                lower_is_better: bool = False) -> list[str]:
+    """Measurements worse than the baseline's by more than `tolerance` (a
+    fraction); measurements missing from the baseline are skipped."""
+
+    base = measure(baseline)
+    worse = []
+    for name, value in measure(result).items():
+        if name not in base:
+            continue
+        if lower_is_better:
+            regressed = value > base[name] * (1 + tolerance)
+        else:
+            regressed = value < base[name] * (1 - tolerance)
+        if regressed:
+            worse.append('%s: %s -> %s %s'
+                         % (name, base[name], value, unit))
+    return worse
+
+
+def report(args: argparse.Namespace, result: dict[str, Any],
+           measure: Measure, unit: str,
+           lower_is_better: bool = False) -> None:
+    """Save the result if asked to, compare it to a baseline if given and
+    print it as JSON; exit with status 1 if anything regressed."""
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            result['regressions'] = regressions(
+                result, json.load(f), measure, args.tolerance, unit,
+                lower_is_better)
+    print(json.dumps(result, indent=2))
+    if len(result.get('regressions', [])) > 0:
+        sys.exit(1)
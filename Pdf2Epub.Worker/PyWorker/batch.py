@@ -0,0 +1,147 @@
+from typing import Iterator
+from dataclasses import dataclass, asdict, replace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import os
+import time
+import json
+
+from main import ConvertOptions, convert_session
+from cache import ResultCache
+from instrument import PipelineStats, log_stats
+from images import ImageStats
+from document import Session
+
+
+@dataclass
+class BatchResult:
+    src: str
+    status: str  # 'ok' or 'error'
+    epub: str | None = None
+    pages: int | None = None
+    seconds: float = 0.0
+    size: int | None = None
+    image_bytes_saved: int | None = None
+    # Whether the ePub was copied from the result cache
+    cached: bool = False
+    # Stage timing and counters, if requested
+    stats: dict | None = None
+    error: str | None = None
+
+
+def find_pdfs(root: str) -> list[str]:
+    """Find all PDF files under a directory."""
+
+    pdfs = []
+    for path, dirs, files in os.walk(root, topdown=False):
+        for name in files:
+            if os.path.splitext(name)[1] == '.pdf':
+                pdfs.append(os.path.join(path, name))
+    return pdfs
+
+
+def convert_one(opt: ConvertOptions, src: str,
+                cache: ResultCache | None = None,
+                stats_log: str | None = None) -> BatchResult:
+    """Convert a PDF file and put the ePub next to it.
+
+    Never raises: a failure is recorded in the returned result so that one
+    broken document doesn't stop the rest of the batch. With `stats_log`,
+    the stages are metered and logged there (see `log_stats`)."""
+
+    start = time.perf_counter()
+    result = BatchResult(src=src, status='ok')
+    try:
+        epub_path = os.path.splitext(src)[0] + '.epub'
+        key = cache.key(asdict(opt), src) if cache is not None else None
+        if cache is not None and cache.get(key, epub_path) is not None:
+            result.cached = True
+        else:
+            image_stats = ImageStats()
+            stats = PipelineStats() if stats_log is not None else None
+            with Session(src) as session:
+                result.pages = session.page_count
+                convert_session(opt, session, epub_path, image_stats, stats)
+            result.image_bytes_saved = image_stats.bytes_saved
+            if stats is not None:
+                result.stats = stats.as_dict()
+                log_stats(stats_log, {'file': src, 'epub': epub_path,
+                                      **result.stats})
+            if cache is not None:
+                cache.put(key, epub_path)
+        result.epub = epub_path
+        result.size = os.path.getsize(epub_path)
+    except Exception as e:
+        result = failed(src, e)
+    result.seconds = round(time.perf_counter() - start, 3)
+    return result
+
+
+def convert_batch(opt: ConvertOptions, srcs: list[str], workers: int,
+                  cache: ResultCache | None = None,
+                  stats_log: str | None = None,
+                  image_workers: int = 1) -> Iterator[BatchResult]:
+    """Convert documents concurrently in a pool of at most `workers`
+    processes, yielding results as they complete.
+
+    Documents converted concurrently recompress their images with
+    `image_workers` processes each instead of `opt.image_workers`, so that
+    the workers don't start a pool of as many processes as CPUs each."""
+
+    if workers <= 1:
+        for src in srcs:
+            yield convert_one(opt, src, cache, stats_log)
+        return
+    opt = replace(opt, image_workers=image_workers)
+    lost = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(convert_one, opt, src, cache, stats_log):
+                   src for src in srcs}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except BrokenProcessPool:
+                lost.append(futures[future])
+            except Exception as e:
+                yield failed(futures[future], e)
+    # A worker died (e.g. killed for memory) and broke the pool, failing
+    # every document it hadn't finished; convert those again one at a time
+    # so that only the one that crashes fails
+    for src in lost:
+        yield convert_isolated(opt, src, cache, stats_log)
+
+
+def failed(src: str, e: Exception) -> BatchResult:
+    """Report an exception as the failure of a document."""
+
+    return BatchResult(src=src, status='error',
+                       error='%s: %s' % (type(e).__name__, e))
+
+
+def convert_isolated(opt: ConvertOptions, src: str,
+                     cache: ResultCache | None = None,
+                     stats_log: str | None = None) -> BatchResult:
+    """Convert a document like `convert_one`, in a process of its own so
+    that the process crashing is reported as a failure."""
+
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        try:
+            return executor.submit(convert_one, opt, src, cache,
+                                   stats_log).result()
+        except Exception as e:
+            return failed(src, e)
+
+
+def summarize(results: list[BatchResult], seconds: float) -> str:
+    """Make a JSON summary of a batch run."""
+
+    n_ok = sum(1 for r in results if r.status == 'ok')
+    n_cached = sum(1 for r in results if r.cached)
+    return json.dumps({
+        'total': len(results),
+        'ok': n_ok,
+        'failed': len(results) - n_ok,
+        'cached': n_cached,
+        'seconds': round(seconds, 3),
+        'files': [asdict(r) for r in sorted(results, key=lambda r: r.src)]
+    }, ensure_ascii=False)
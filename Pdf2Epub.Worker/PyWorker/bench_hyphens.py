@@ -0,0 +1,97 @@
+"""Measure the throughput of joining words hyphenated across lines.
+
+A hyphen-heavy corpus is generated from the lexicon: every line ends in a
+word split by a hyphen, and words are drawn with a Zipf distribution, so
+fragments recur the way they do in a book; a share of the splits are of
+compounds ("well-known"), whose hyphen must stay. `merge_texts` is run on
+every line break with the word lookup memoized and not memoized, and
+lines/s and the memo's hit rate are reported as JSON. With --baseline,
+results are compared to a previous run saved with --save, and the exit
+status is 1 if a configuration got slower by more than --tolerance."""
+
+from typing import Any
+import argparse
+import random
+import sys
+import time
+
+import baseline
+import main
+from lexicon import Lexicon, WordLookup
+
+
+def make_corpus(n_lines: int, n_words: int, compounds: float,
+                seed: int) -> list[tuple[str, str]]:
+    """Pairs of consecutive lines, the first ending in a hyphen."""
+
+    rng = random.Random(seed)
+    data = Lexicon().load()
+    words = [w for w in data[:].decode().split('\n')
+             if len(w) >= 6 and w.isalpha() and w.islower()]
+    words = rng.sample(words, min(n_words, len(words)))
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    pairs = []
+    for word in rng.choices(words, weights, k=n_lines):
+        if rng.random() < compounds:
+            left, right = word, rng.choice(words)
+        else:
+            i = rng.randint(2, len(word) - 2)
+            left, right = word[:i], word[i:]
+        pairs.append(('the quick brown fox jumps over ' + left + '-',
+                      right + ' the lazy dog'))
+    return pairs
+
+
+def bench(pairs: list[tuple[str, str]], memo_size: int,
+          repeat: int) -> dict[str, Any]:
+    """Join every pair of lines with a fresh word lookup, `repeat` times,
+    keeping the fastest run."""
+
+    saved = main.english_words_
+    best = float('inf')
+    try:
+        for _ in range(repeat):
+            lookup = WordLookup(saved.lexicon, memo_size)
+            main.english_words_ = lookup
+            start = time.perf_counter()
+            for t1, t2 in pairs:
+                main.merge_texts(t1, t2, line_break=True)
+            best = min(best, time.perf_counter() - start)
+    finally:
+        main.english_words_ = saved
+    lookups = lookup.hits + lookup.misses
+    return {
+        'memo_size': memo_size,
+        'seconds': round(best, 4),
+        'lines_per_s': round(len(pairs) / best, 1),
+        'hit_rate': round(lookup.hits / lookups, 3) if lookups > 0 else 0.0
+    }
+
+
+def measure(result: dict[str, Any]) -> dict[str, float]:
+    """Throughput of each configuration."""
+
+    return {'memo %d' % (run['memo_size'],): run['lines_per_s']
+            for run in result['runs']}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=100000,
+                        help='number of hyphenated line breaks')
+    parser.add_argument('--words', type=int, default=20000,
+                        help='number of distinct words drawn from')
+    parser.add_argument('--compounds', type=float, default=0.2,
+                        help='share of line breaks within compounds')
+    parser.add_argument('--memo-size', type=int, nargs='+',
+                        default=[0, 4096])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    baseline.add_arguments(parser)
+    args = parser.parse_args()
+
+    pairs = make_corpus(args.lines, args.words, args.compounds, args.seed)
+    result = {'python': sys.version.split()[0], 'lines': len(pairs),
+              'runs': [bench(pairs, size, args.repeat)
+                       for size in args.memo_size]}
+    baseline.report(args, result, measure, 'lines/s')
@@ -0,0 +1,97 @@
+"""Measure cold-start cost of the converter.
+
+Reports the import time of every module (from `python -X importtime`) and
+the wall-clock time of fresh interpreters importing `main` and, optionally,
+converting a PDF. Results are printed as JSON; with --baseline, they're
+compared to a previous run saved with --save, and the exit status is 1 if
+any wall-clock median regressed by more than --tolerance."""
+
+from typing import Any
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import baseline
+
+module_dir_ = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_times(module: str = 'main') -> list[dict[str, Any]]:
+    """Import a module in a fresh interpreter, returning the self and
+    cumulative import time (in microseconds) of each module loaded."""
+
+    proc = subprocess.run([sys.executable, '-X', 'importtime',
+                           '-c', 'import ' + module],
+                          cwd=module_dir_, capture_output=True, text=True)
+    times = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        times.append({
+            'module': fields[2].strip(),
+            'self_us': int(fields[0]),
+            'cumulative_us': int(fields[1])
+        })
+    return times
+
+
+def wall_times(args: list[str], runs: int) -> dict[str, float]:
+    """Run a fresh interpreter `runs` times, returning statistics of its
+    wall-clock time in seconds."""
+
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], cwd=module_dir_,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       check=True)
+        samples.append(time.perf_counter() - start)
+    return {
+        'median': round(statistics.median(samples), 4),
+        'min': round(min(samples), 4),
+        'max': round(max(samples), 4)
+    }
+
+
+def benchmark(runs: int, pdf: str | None, top: int) -> dict[str, Any]:
+    times = import_times()
+    times.sort(key=lambda t: t['cumulative_us'], reverse=True)
+    result = {
+        'python': sys.version.split()[0],
+        'imports': times[:top],
+        'wall': {
+            'interpreter': wall_times(['-c', 'pass'], runs),
+            'import_main': wall_times(['-c', 'import main'], runs)
+        }
+    }
+    if pdf is not None:
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, 'out')
+            result['wall']['convert'] = wall_times(
+                ['main.py', os.path.abspath(pdf), '--name', out], runs)
+    return result
+
+
+def measure(result: dict[str, Any]) -> dict[str, float]:
+    """Median wall-clock time of each measurement."""
+
+    return {name: wall['median'] for name, wall in result['wall'].items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--pdf', type=str,
+                        help='also time converting this PDF file')
+    parser.add_argument('--top', type=int, default=20,
+                        help='number of slowest imports to report')
+    baseline.add_arguments(parser)
+    args = parser.parse_args()
+
+    result = benchmark(args.runs, args.pdf, args.top)
+    baseline.report(args, result, measure, 's', lower_is_better=True)
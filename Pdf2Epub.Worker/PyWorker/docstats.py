@@ -0,0 +1,159 @@
+from dataclasses import dataclass, field
+
+from line import Line, LineType
+
+# Number of pages the statistics pre-pass samples evenly over a document
+SAMPLE_PAGES = 16
+
+
+@dataclass
+class DocumentStats:
+    """Typographic statistics of a document, estimated from a sample of its
+    pages."""
+
+    pages_sampled: int = 0
+    # Font size covering the most characters
+    body_size: float = 0.0
+    # Font sizes of headings, largest first
+    heading_sizes: list[float] = field(default_factory=list)
+    # Fraction of characters in lines that run top to bottom
+    vertical: float = 0.0
+    # Typical number of columns (of bands, for vertical writing) on a page
+    columns: int = 1
+    # Fraction of pages with images but no text, e.g. scans
+    image_only_pages: float = 0.0
+
+
+def sample_pages(n_pages: int, toc_pages: list[int] = (),
+                 n_samples: int = SAMPLE_PAGES) -> list[int]:
+    """Numbers of at most `n_samples` pages spread evenly over a document,
+    including the first and the last one, plus at most as many pages that
+    the table of contents points to, where headings are sure to be."""
+
+    if n_pages <= n_samples:
+        return list(range(n_pages))
+    pages = {round(i * (n_pages - 1) / (n_samples - 1))
+             for i in range(n_samples)}
+    toc_pages = sorted({p for p in toc_pages if 0 <= p < n_pages} - pages)
+    step = max(1, len(toc_pages) // n_samples)
+    pages.update(toc_pages[::step][:n_samples])
+    return sorted(pages)
+
+
+def size_histogram(pages: list[list[Line]]) -> dict[float, int]:
+    """Number of characters set in each font size, rounded to half
+    points."""
+
+    hist = {}
+    for lines in pages:
+        for line in lines:
+            if line.type != LineType.TEXT:
+                continue
+            for span in line.spans:
+                n = len(span.text.strip())
+                if n > 0:
+                    size = round(span.style[0] * 2) / 2
+                    hist[size] = hist.get(size, 0) + n
+    return hist
+
+
+def heading_tiers(hist: dict[float, int], body_size: float,
+                  max_tiers: int = 4) -> list[float]:
+    """Sizes noticeably larger than the body size and used much less, so
+    that they can't be the body of another part of the document."""
+
+    if body_size <= 0:
+        return []
+    bound = hist[body_size] * 0.2
+    sizes = sorted((size for size, n in hist.items()
+                    if size >= body_size * 1.15 and n < bound),
+                   reverse=True)
+    return sizes[:max_tiers]
+
+
+def is_vertical_line(line: Line) -> bool:
+    l, u, r, d = line.bbox
+    return d - u > 2 * (r - l)
+
+
+def follows_vertically(prev: Line, line: Line) -> bool | None:
+    """Whether a character extracted as a line of its own continues the
+    one before downwards (True) or to the right (False); None if neither,
+    e.g. at the start of a column."""
+
+    pl, pu, pr, pd = prev.bbox
+    l, u, r, d = line.bbox
+    if l < pr and r > pl and u > pu:
+        return True
+    if u < pd and d > pu and l > pl:
+        return False
+    return None
+
+
+def count_columns(lines: list[Line], vertical: bool) -> int:
+    """Count columns on a page as groups of overlapping line extents, not
+    counting lines spanning most of the page (e.g. headings) nor groups
+    of fewer than three lines."""
+
+    extents = []
+    for line in lines:
+        if line.type != LineType.TEXT:
+            continue
+        l, u, r, d = line.bbox
+        extents.append((u, d) if vertical else (l, r))
+    if len(extents) == 0:
+        return 0
+    width = max(e[1] for e in extents) - min(e[0] for e in extents)
+    extents = sorted(e for e in extents if e[1] - e[0] <= 0.6 * width)
+    groups, end, size = 0, float('-inf'), 0
+    for lo, hi in extents:
+        if lo > end:
+            groups += size >= 3
+            size = 0
+        end = max(end, hi)
+        size += 1
+    groups += size >= 3
+    return max(groups, 1)
+
+
+def analyze(pages: list[list[Line]]) -> DocumentStats:
+    """Compute document statistics from the raw lines of sampled pages."""
+
+    stats = DocumentStats(pages_sampled=len(pages))
+    if len(pages) == 0:
+        return stats
+    hist = size_histogram(pages)
+    if len(hist) > 0:
+        stats.body_size = max(hist, key=hist.get)
+        stats.heading_sizes = heading_tiers(hist, stats.body_size)
+
+    n_chars = n_vertical = n_image_only = 0
+    for lines in pages:
+        has_text = has_image = False
+        prev = None
+        for line in lines:
+            if line.type != LineType.TEXT:
+                has_image = True
+                continue
+            n = sum(len(span.text.strip()) for span in line.spans)
+            has_text = has_text or n > 0
+            if n >= 2:
+                n_chars += n
+                n_vertical += n if is_vertical_line(line) else 0
+            elif n == 1 and prev is not None:
+                # Single characters are as tall as they're wide, so look
+                # at where they are from the one before instead
+                vertical = follows_vertically(prev, line)
+                if vertical is not None:
+                    n_chars += 1
+                    n_vertical += vertical
+            prev = line if n == 1 else None
+        n_image_only += has_image and not has_text
+    stats.vertical = round(n_vertical / n_chars, 3) if n_chars > 0 else 0.0
+    stats.image_only_pages = round(n_image_only / len(pages), 3)
+
+    counts = sorted(c for c in (count_columns(lines, stats.vertical > 0.5)
+                                for lines in pages) if c > 0)
+    if len(counts) > 0:
+        stats.columns = counts[len(counts) // 2]
+    return stats
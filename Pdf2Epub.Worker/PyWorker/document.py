@@ -0,0 +1,129 @@
+from typing import Any
+
+import cache
+from spill import SpillFile
+import utils
+
+fitz = utils.lazy_import('fitz')
+
+# Open sessions by file name, through which lazily read images are read
+sessions_: dict[str, 'Session'] = {}
+
+# Number of images recently read by xref that a session keeps, so that an
+# image repeated on many pages is only decoded once in a row
+IMAGE_MEMO_SIZE = 8
+
+
+class Session:
+    """A PDF document opened once and shared by all conversion stages.
+
+    Title, table of contents and metadata are read lazily and memoized, so
+    that asking for them from several stages never re-parses the document."""
+
+    def __init__(self, src: str):
+        self.src = src
+        self.doc = fitz.open(src)
+        self._toc = None
+        self._metadata = None
+        self._digest = None
+        self._spill = None
+        self._images = {}
+        # Results of the statistics pre-pass, and the lines of the pages it
+        # sampled, kept until extraction takes them
+        self.statistics = None
+        self.sampled_lines: dict[int, list] = {}
+        sessions_[src] = self
+
+    @property
+    def page_count(self) -> int:
+        return self.doc.page_count
+
+    @property
+    def metadata(self) -> dict[str, Any]:
+        if self._metadata is None:
+            self._metadata = self.doc.metadata or {}
+        return self._metadata
+
+    @property
+    def title(self) -> str:
+        title = self.metadata.get('title')
+        return 'PDF2ePub' if not title else title
+
+    @property
+    def toc(self) -> list[list]:
+        if self._toc is None:
+            self._toc = self.doc.get_toc()
+        return self._toc
+
+    @property
+    def digest(self) -> str:
+        """Hash of the PDF file, identifying the document in caches."""
+
+        if self._digest is None:
+            self._digest = cache.file_digest(self.src)
+        return self._digest
+
+    @property
+    def spill(self) -> SpillFile:
+        """A temporary file for large data of the conversion, removed when
+        the session is closed."""
+
+        if self._spill is None:
+            self._spill = SpillFile()
+        return self._spill
+
+    def image(self, xref: int) -> dict[str, Any]:
+        """The image of an xref as returned by `extract_image`, memoized for
+        the last few images."""
+
+        image = self._images.pop(xref, None)
+        if image is None:
+            image = self.doc.extract_image(xref)
+            if len(self._images) >= IMAGE_MEMO_SIZE:
+                self._images.pop(next(iter(self._images)))
+        self._images[xref] = image
+        return image
+
+    def close(self) -> None:
+        """Close the document, releasing its file handle and MuPDF caches."""
+
+        if not self.doc.is_closed:
+            self.doc.close()
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        self._images.clear()
+        if sessions_.get(self.src) is self:
+            del sessions_[self.src]
+
+    def __enter__(self) -> 'Session':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class LazyImage:
+    """An image of a PDF file that is only read, by its xref, when it's used.
+
+    It's read through the open session of the file, or by opening the file
+    again if there's none, so a reference stays valid when it's passed from
+    a worker process or stored in the page cache."""
+
+    __slots__ = ('src', 'xref', 'ext')
+
+    def __init__(self, src: str, xref: int):
+        self.src = src
+        self.xref = xref
+        # Known once the image has been read
+        self.ext = None
+
+    def load(self) -> bytes:
+        session = sessions_.get(self.src)
+        if session is not None:
+            image = session.image(self.xref)
+        else:
+            with Session(self.src) as session:
+                image = session.image(self.xref)
+        self.ext = image['ext']
+        return image['image']
@@ -1,11 +1,15 @@
-from typing import Iterator
-from dataclasses import dataclass
+from typing import BinaryIO, Iterator
+from dataclasses import dataclass, field
 from contextlib import contextmanager
+import hashlib
+import io
 import os
-import shutil
 import tempfile
 import zipfile
 
+from spill import SpilledBytes, SpillFile
+from textclass import CONTROL, classify
+
 
 @dataclass
 class EpubData:
@@ -13,46 +17,355 @@ class EpubData:
     html: str
 
 
-@contextmanager
-def push_dir(path: str) -> Iterator[None]:
-    """A simulation of `pushdir` and `popdir` command."""
+@dataclass
+class Chapter:
+    id: str
+    title: str
 
-    prev_path = os.getcwd()
-    try:
-        os.chdir(path)
-        yield
-    finally:
-        os.chdir(prev_path)
+    @property
+    def href(self) -> str:
+        return self.id + '.html'
+
+
+@dataclass
+class NavPoint:
+    level: int
+    label: str
+    src: str
+    children: list['NavPoint'] = field(default_factory=list)
+
+
+@dataclass
+class Resource:
+    id: str
+    href: str
+    media_type: str
+
+
+MEDIA_TYPES = {
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'svg': 'image/svg+xml'
+}
+
+
+def media_type(ext: str) -> str:
+    return MEDIA_TYPES.get(ext, 'image/' + ext)
+
+
+# Escapes HTML special characters and drops control characters (which are
+# invalid in XML) in a single pass; control characters are all ASCII, so
+# they're classified here rather than building the whole class table
+ESCAPE_TABLE = str.maketrans({
+    **dict.fromkeys(ch for ch in map(chr, range(0x80))
+                    if classify(ch) & CONTROL),
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    '"': '&quot;',
+    "'": '&#x27;'
+})
 
 
-def duplicate_template() -> str:
-    """Make a copy of the template directory."""
+def escape(text: str) -> str:
+    """Escape text for use in XHTML content or attribute values."""
 
-    module_dir = os.path.split(__file__)[0]
-    template_dir = os.path.join(module_dir, 'template')
-    return shutil.copytree(template_dir, tempfile.mktemp())
+    return text.translate(ESCAPE_TABLE)
 
 
-def create_epub(epub_data: EpubData) -> str:
-    """Create an ePub file based on given data and the template."""
+# Template entries filled in by `EpubWriter` rather than copied verbatim
+PAGE = 'OEBPS/page.html'
+OPF = 'OEBPS/fb.opf'
+NCX = 'OEBPS/fb.ncx'
+STYLE = 'OEBPS/css/style.css'
+
+template_: dict[str, bytes] | None = None
+
+# Number of characters buffered before they're written to a chapter
+FLUSH_SIZE = 64 * 1024
+
+
+def load_template() -> dict[str, bytes]:
+    """Read the template directory into memory (once per process).
+
+    Returns a dict from archive names to contents, with `mimetype` first."""
+
+    global template_
 
     def is_unwanted_file(fname: str) -> bool:
         """Whether a file is unwanted in the generated ePub result."""
 
         return fname in ['.DS_Store']
 
-    with push_dir(duplicate_template()):
-        with open('OEBPS/page-00001.html', 'r') as f:
-            html_template = f.read()
-        with open('OEBPS/page-00001.html', 'w') as f:
-            f.write(html_template.format(
-                body=epub_data.html
-            ))
-        fname = tempfile.mktemp(suffix='.epub')
-        with zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(os.curdir):
-                for file in files:
-                    if is_unwanted_file(os.path.split(file)[1]):
-                        continue
-                    zipf.write(os.path.join(root, file))
-    return fname
+    if template_ is None:
+        module_dir = os.path.split(__file__)[0]
+        template_dir = os.path.join(module_dir, 'template')
+        entries = {'mimetype': b''}
+        for root, dirs, files in os.walk(template_dir):
+            dirs.sort()
+            for file in sorted(files):
+                if is_unwanted_file(file):
+                    continue
+                path = os.path.join(root, file)
+                name = os.path.relpath(path, template_dir).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    entries[name] = f.read()
+        template_ = entries
+    return template_
+
+
+class EpubWriter:
+    """Write an ePub file chapter by chapter to a binary file-like object.
+
+    Each chapter is streamed into its own XHTML entry and finished before
+    the next one begins; the manifest, spine and NCX are generated from the
+    chapters (and navigation points) when the writer is closed. `mimetype`
+    is stored uncompressed as the first entry, as the OCF spec requires."""
+
+    def __init__(self, f: BinaryIO, title: str):
+        self.title = title
+        # Path of the file being written, if it is a file on disk
+        self.path: str | None = None
+        self.template = load_template()
+        self.zipf = zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED)
+        self.chapters: list[Chapter] = []
+        self.nav_points: list[NavPoint] = []
+        self.resources: list[Resource] = []
+        # Href of each image written so far, by content hash
+        self.images: dict[str, str] = {}
+        # Resources waiting for the current chapter's entry to be closed,
+        # since a zip file can't be written to while an entry is open; they
+        # wait in a spill file, so a chapter with many images doesn't hold
+        # them all in memory
+        self.pending: list[tuple[str, SpilledBytes]] = []
+        self.spill: SpillFile | None = None
+        # Class name of each distinct set of CSS declarations
+        self.styles: dict[str, str] = {}
+        self.page = None
+        self.page_tail = b''
+        # Fragments not yet written to the current chapter's entry; they're
+        # flushed in chunks to keep per-write overhead of the zip entry low
+        self.buffer: list[str] = []
+        self.buffered = 0
+        # Number of characters written to the current chapter
+        self.size = 0
+        self.zipf.writestr('mimetype', self.template['mimetype'],
+                           compress_type=zipfile.ZIP_STORED)
+        for name, data in self.template.items():
+            if name not in ('mimetype', PAGE, OPF, NCX, STYLE):
+                self.zipf.writestr(name, data)
+
+    def begin_chapter(self, title: str | None = None) -> Chapter:
+        """Finish the current chapter, if any, and start a new one."""
+
+        self.end_chapter()
+        chapter = Chapter(id='page-%05d' % (len(self.chapters) + 1,),
+                          title=title if title is not None else self.title)
+        self.chapters.append(chapter)
+        head, tail = self.template[PAGE].decode().split('{body}')
+        head = head.replace('{title}', escape(chapter.title))
+        self.page = self.zipf.open('OEBPS/' + chapter.href, 'w')
+        self.page.write(head.encode())
+        self.page_tail = tail.encode()
+        self.size = 0
+        return chapter
+
+    def write(self, fragment: str) -> None:
+        """Append an HTML fragment to the current chapter."""
+
+        if self.page is None:
+            self.begin_chapter()
+        self.buffer.append(fragment)
+        self.buffered += len(fragment)
+        self.size += len(fragment)
+        if self.buffered >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        if len(self.buffer) > 0:
+            self.page.write(''.join(self.buffer).encode())
+            self.buffer = []
+            self.buffered = 0
+
+    def end_chapter(self) -> None:
+        if self.page is not None:
+            self.flush()
+            self.page.write(self.page_tail)
+            self.page.close()
+            self.page = None
+        for name, spilled in self.pending:
+            # Images are compressed already
+            self.zipf.writestr(name, spilled.load(),
+                               compress_type=zipfile.ZIP_STORED)
+        self.pending = []
+        if self.spill is not None:
+            self.spill.clear()
+
+    def add_style(self, declarations: str) -> str:
+        """Get the name of a CSS class with the given declarations; the
+        rules are added to the stylesheet when the writer is closed."""
+
+        if declarations not in self.styles:
+            self.styles[declarations] = 's%d' % (len(self.styles) + 1,)
+        return self.styles[declarations]
+
+    def add_image(self, data: bytes, ext: str) -> str:
+        """Add an image as a separate resource and return its href
+        (relative to the chapters).
+
+        Images are deduplicated by content, so an image used on many pages
+        is stored only once."""
+
+        key = hashlib.blake2b(data, digest_size=16).hexdigest()
+        if key not in self.images:
+            href = 'images/%s.%s' % (key, ext)
+            self.resources.append(Resource(id='img-' + key, href=href,
+                                           media_type=media_type(ext)))
+            if self.page is None:
+                self.zipf.writestr('OEBPS/' + href, data,
+                                   compress_type=zipfile.ZIP_STORED)
+            else:
+                if self.spill is None:
+                    self.spill = SpillFile()
+                self.pending.append(('OEBPS/' + href, self.spill.store(data)))
+            self.images[key] = href
+        return self.images[key]
+
+    def add_nav_point(self, level: int, label: str,
+                      anchor: str | None = None) -> None:
+        """Add an entry to the table of contents (NCX), pointing to the
+        current chapter, or to an element with id `anchor` in it."""
+
+        if self.page is None:
+            self.begin_chapter()
+        src = self.chapters[-1].href
+        if anchor is not None:
+            src += '#' + anchor
+        point = NavPoint(level=level, label=label, src=src)
+        siblings = self.nav_points
+        while len(siblings) > 0 and siblings[-1].level < level:
+            siblings = siblings[-1].children
+        siblings.append(point)
+
+    def close(self) -> None:
+        """Finish the last chapter and write the package files."""
+
+        if len(self.chapters) == 0:
+            self.begin_chapter()
+        self.end_chapter()
+        if len(self.nav_points) == 0:
+            self.nav_points = [NavPoint(level=1, label=c.id, src=c.href)
+                               for c in self.chapters]
+        title = escape(self.title)
+
+        css = self.template[STYLE].decode().rstrip('\n') + '\n' + ''.join(
+            '.%s { %s }\n' % (name, declarations)
+            for declarations, name in self.styles.items())
+        self.zipf.writestr(STYLE, css)
+
+        items = [Resource(id=c.id, href=c.href,
+                          media_type='application/xhtml+xml')
+                 for c in self.chapters] + self.resources
+        manifest = '\n'.join(
+            '\t\t<item id="%s" href="%s" media-type="%s"/>'
+            % (r.id, r.href, r.media_type) for r in items)
+        spine = '\n'.join('\t\t<itemref idref="%s" linear="yes"/>' % (c.id,)
+                          for c in self.chapters)
+        opf = self.template[OPF].decode() \
+            .replace('{title}', title) \
+            .replace('{manifest}', manifest) \
+            .replace('{spine}', spine)
+        self.zipf.writestr(OPF, opf)
+
+        nav_map, depth = self.nav_map()
+        ncx = self.template[NCX].decode() \
+            .replace('{title}', title) \
+            .replace('{depth}', str(depth)) \
+            .replace('{nav_map}', nav_map)
+        self.zipf.writestr(NCX, ncx)
+        self.zipf.close()
+        if self.spill is not None:
+            self.spill.close()
+
+    def nav_map(self) -> tuple[str, int]:
+        """Render navigation points as nested NCX navPoints; returns the
+        XML and the depth of the tree."""
+
+        lines = []
+        order = 0
+
+        def render(points: list[NavPoint], indent: int) -> int:
+            nonlocal order
+            tabs = '\t' * indent
+            depth = 0
+            for point in points:
+                order += 1
+                lines.append('%s<navPoint id="navpoint-%d" playOrder="%d">'
+                             % (tabs, order, order))
+                lines.append('%s\t<navLabel><text>%s</text></navLabel>'
+                             % (tabs, escape(point.label)))
+                lines.append('%s\t<content src="%s"/>' % (tabs, point.src))
+                depth = max(depth, render(point.children, indent + 1) + 1)
+                lines.append('%s</navPoint>' % (tabs,))
+            return depth
+
+        depth = render(self.nav_points, 2)
+        return '\n'.join(lines), depth
+
+    def __enter__(self) -> 'EpubWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            if self.page is not None:
+                self.page.close()
+            self.zipf.close()
+            if self.spill is not None:
+                self.spill.close()
+
+
+@contextmanager
+def open_epub(title: str, dest: str | None = None) -> Iterator[EpubWriter]:
+    """Create an ePub file at `dest` (or at a new temporary path if not
+    given) and yield a writer for it; the path is the writer's `path`.
+
+    A partially written file is removed if writing fails."""
+
+    if dest is None:
+        fd, dest = tempfile.mkstemp(suffix='.epub')
+        os.close(fd)
+    try:
+        with open(dest, 'wb') as f:
+            with EpubWriter(f, title) as writer:
+                writer.path = dest
+                yield writer
+    except BaseException:
+        os.remove(dest)
+        raise
+
+
+def write_epub(epub_data: EpubData, f: BinaryIO) -> None:
+    """Write a single-chapter ePub file to a binary file-like object."""
+
+    with EpubWriter(f, epub_data.title) as writer:
+        writer.write(epub_data.html)
+
+
+def epub_bytes(epub_data: EpubData) -> bytes:
+    """Make an ePub file in memory."""
+
+    buf = io.BytesIO()
+    write_epub(epub_data, buf)
+    return buf.getvalue()
+
+
+def create_epub(epub_data: EpubData, dest: str | None = None) -> str:
+    """Create a single-chapter ePub file and return its path."""
+
+    with open_epub(epub_data.title, dest) as writer:
+        writer.write(epub_data.html)
+    return writer.path
@@ -0,0 +1,251 @@
+from typing import Iterator
+from dataclasses import dataclass
+from collections import deque
+import hashlib
+import struct
+import zlib
+
+from line import Line, LineType, line_type
+import utils
+
+fitz = utils.lazy_import('fitz')
+np = utils.lazy_import('numpy')
+
+# Images of a stream recompressed in the current process before a process
+# pool is worth starting
+INLINE_IMAGES = 4
+# Low bits of each color channel that may be dropped to fit an image that
+# is re-encoded anyway into a palette
+QUANTIZE_BITS = 3
+
+
+@dataclass
+class ImageStats:
+    count: int = 0
+    # Images that were re-encoded (possibly downsampled) to something smaller
+    recompressed: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.bytes_in - self.bytes_out
+
+
+def target_size(width: int, height: int, bbox: tuple, dpi: int) \
+        -> tuple[int, int]:
+    """Pixel size needed to show an image at `dpi` in its displayed bounding
+    box (in points, 1/72 inch); never larger than the image itself."""
+
+    l, u, r, d = bbox
+    scale = min(1.0, (r - l) / 72 * dpi / width, (d - u) / 72 * dpi / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + kind + data \
+        + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def palette_png(pix: 'fitz.Pixmap', max_bits: int = 0) -> bytes | None:
+    """Encode a pixmap as a palette PNG, if it has at most 256 colors once
+    at most `max_bits` low bits of each color channel (not alpha) are
+    dropped. Returns None if it has more, e.g. photos."""
+
+    n = pix.n
+    if pix.colorspace is None or pix.width * pix.height == 0:
+        return None
+    pixels = np.frombuffer(pix.samples, np.uint8).reshape(-1, n)
+    n_colors = n - pix.alpha
+    # Try the colors of a sample of pixels first, which rules photos out
+    # without sorting all their pixels
+    step = max(1, len(pixels) // 4096)
+    for bits in range(max_bits + 1):
+        keys = np.zeros(len(pixels[::step]), np.uint32)
+        for c in range(n):
+            channel = pixels[::step, c].astype(np.uint32)
+            keys = keys << 8 | (channel >> bits if c < n_colors else channel)
+        if len(np.unique(keys)) <= 256:
+            break
+    else:
+        return None
+
+    keys = np.zeros(len(pixels), np.uint32)
+    for c in range(n):
+        channel = pixels[:, c].astype(np.uint32)
+        keys = keys << 8 | (channel >> bits if c < n_colors else channel)
+    colors, index = np.unique(keys, return_inverse=True)
+    if len(colors) > 256:
+        return None
+    # Unpack the palette, putting dropped bits back in the middle of their
+    # range
+    channels = [(colors >> (8 * (n - 1 - c))) & 0xff for c in range(n)]
+    for c in range(n_colors):
+        channels[c] = (channels[c] << bits) | ((1 << bits) >> 1)
+    if pix.alpha:
+        # Pixmaps are premultiplied, PNGs aren't
+        alpha = np.maximum(channels[-1], 1)
+        for c in range(n_colors):
+            channels[c] = np.minimum(
+                (channels[c] * 255 + alpha // 2) // alpha, 255)
+    rgb = channels[:n_colors] * 3 if n_colors == 1 else channels[:3]
+    palette = np.stack(rgb, axis=1).astype(np.uint8).tobytes()
+
+    depth = next(d for d in (1, 2, 4, 8) if len(colors) <= 1 << d)
+    per_byte = 8 // depth
+    index = index.reshape(pix.height, pix.width).astype(np.uint8)
+    pad = -pix.width % per_byte
+    index = np.pad(index, ((0, 0), (0, pad)))
+    index = index.reshape(pix.height, -1, per_byte)
+    rows = np.zeros(index.shape[:2], np.uint8)
+    for i in range(per_byte):
+        rows |= index[:, :, i] << (8 - depth * (i + 1))
+    # Rows start with a filter type, none
+    rows = np.hstack([np.zeros((pix.height, 1), np.uint8), rows])
+
+    chunks = [png_chunk(b'IHDR', struct.pack('>IIBBBBB', pix.width,
+                                             pix.height, depth, 3, 0, 0, 0)),
+              png_chunk(b'PLTE', palette)]
+    if pix.alpha:
+        chunks.append(png_chunk(b'tRNS',
+                                channels[-1].astype(np.uint8).tobytes()))
+    chunks.append(png_chunk(b'IDAT', zlib.compress(rows.tobytes(), 9)))
+    chunks.append(png_chunk(b'IEND', b''))
+    return b'\x89PNG\r\n\x1a\n' + b''.join(chunks)
+
+
+def recompress(data: bytes, ext: str, size: tuple[int, int],
+               quality: int) -> tuple[bytes, str]:
+    """Downsample an image to `size` (if smaller than the image) and
+    re-encode it: JPEG at `quality`, PNG if it has an alpha channel, or a
+    palette PNG if it has few enough colors (e.g. diagrams), whichever is
+    smallest.
+
+    Lossless images that aren't downsampled are only re-encoded as palette
+    PNGs with their exact colors. Returns the original image if it can't be
+    decoded or the result isn't smaller."""
+
+    try:
+        pix = fitz.Pixmap(data)
+        if pix.colorspace is not None and pix.colorspace.n > 3:
+            pix = fitz.Pixmap(fitz.csRGB, pix)
+        downsample = size[0] < pix.width
+        lossy = downsample or ext in ('jpg', 'jpeg')
+        if downsample:
+            pix = fitz.Pixmap(pix, size[0], size[1], None)
+        candidates = []
+        palette = palette_png(pix, QUANTIZE_BITS if lossy and pix.alpha
+                              else 0)
+        if palette is not None:
+            candidates.append((palette, 'png'))
+        if lossy and pix.alpha:
+            candidates.append((pix.tobytes('png'), 'png'))
+        elif lossy:
+            candidates.append((pix.tobytes('jpeg', jpg_quality=quality),
+                               'jpeg'))
+    except Exception:
+        return data, ext
+    new_data, new_ext = min(candidates, key=lambda c: len(c[0]),
+                            default=(data, ext))
+    if len(new_data) >= len(data):
+        return data, ext
+    return new_data, new_ext
+
+
+class Done:
+    """The result of an image recompressed in the current process, standing
+    in for a future."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def done(self) -> bool:
+        return True
+
+    def result(self):
+        return self.value
+
+
+def can_start_pool(workers: int) -> bool:
+    """Whether recompressing in a pool of `workers` processes is possible
+    and worth it: daemonic processes can't have children."""
+
+    if workers <= 1:
+        return False
+    import multiprocessing
+    return not multiprocessing.current_process().daemon
+
+
+def process_images(dpi: int, quality: int, workers: int,
+                   lines: Iterator[Line], stats: ImageStats | None = None,
+                   executor: 'concurrent.futures.Executor | None' = None) \
+        -> Iterator[Line]:
+    """Downsample and recompress images of a line stream in a process pool,
+    yielding lines in their original order.
+
+    The pool is only started once a stream turns out to have more than a
+    few images; until then, and if there's a single worker or no pool can
+    be started, images are recompressed in the current process. At most two
+    images per worker are in flight at a time, so the stream isn't
+    materialized. Displayed sizes (`width` and `height`) are kept, so
+    readers scale the smaller images back up."""
+
+    if stats is None:
+        stats = ImageStats()
+    own_executor = executor is None
+    window = deque()
+    in_flight = 0
+    # Repeated images (logos, decorations) are only recompressed once, as
+    # long as they recur within the last 64 distinct images
+    submitted = {}
+
+    def finish(line: Line, future, size_in: int) -> Line:
+        nonlocal in_flight
+        if future is not None:
+            in_flight -= 1
+            data, ext = future.result()
+            stats.count += 1
+            stats.bytes_in += size_in
+            stats.bytes_out += len(data)
+            if len(data) < size_in:
+                stats.recompressed += 1
+            line.image, line.ext = data, ext
+        return line
+
+    try:
+        for line in lines:
+            future = None
+            size_in = 0
+            if line_type(line) == LineType.IMAGE:
+                size = target_size(line.width, line.height, line.bbox, dpi)
+                image = line.image
+                size_in = len(image)
+                key = (hashlib.blake2b(image, digest_size=16).digest(), size)
+                if key not in submitted:
+                    if len(submitted) >= 64:
+                        # Forget the oldest result to bound memory
+                        submitted.pop(next(iter(submitted)))
+                    if executor is None and len(submitted) >= INLINE_IMAGES \
+                            and can_start_pool(workers):
+                        from concurrent.futures import ProcessPoolExecutor
+                        executor = ProcessPoolExecutor(max_workers=workers)
+                    if executor is None:
+                        submitted[key] = Done(recompress(
+                            image, line.ext, size, quality))
+                    else:
+                        submitted[key] = executor.submit(
+                            recompress, image, line.ext, size, quality)
+                future = submitted[key]
+                in_flight += 1
+            window.append((line, future, size_in))
+            while len(window) > 0 and (window[0][1] is None
+                                       or window[0][1].done()
+                                       or in_flight > 2 * workers):
+                yield finish(*window.popleft())
+        while len(window) > 0:
+            yield finish(*window.popleft())
+    finally:
+        if own_executor and executor is not None:
+            executor.shutdown(cancel_futures=True)
@@ -5,7 +5,8 @@ T = TypeVar('T')
 
 JsonLike: TypeAlias = dict[str, Any]
 BBox: TypeAlias = tuple[float, float, float, float]
-Line: TypeAlias = JsonLike
+# (size, flags, color) of a span
+Style: TypeAlias = tuple[float, Any, Any]
 
 
 class LineType(Enum):
@@ -13,16 +14,108 @@ class LineType(Enum):
     IMAGE = 2
 
 
-def make_line(data: JsonLike, t: LineType) -> Line:
-    """Add a type tag to line data."""
+styles_: dict[Style, Style] = {}
 
-    assert '_type' not in data
-    data['_type'] = t
-    return data
+
+def intern_style(style: Style) -> Style:
+    """Get the canonical instance of a style, so that spans of the same style
+    share one tuple and can be compared by identity."""
+
+    return styles_.setdefault(style, style)
+
+
+def clear_styles() -> None:
+    """Forget the interned styles. Styles interned before no longer compare
+    by identity to those interned after, so only call it between
+    conversions."""
+
+    styles_.clear()
+
+
+class Span:
+    """A piece of text of the same style within a line."""
+
+    __slots__ = ('text', 'bbox', 'style')
+
+    def __init__(self, text: str, bbox: BBox, style: Style):
+        self.text = text
+        self.bbox = bbox
+        self.style = style
+
+    @property
+    def size(self) -> float:
+        return self.style[0]
+
+    @property
+    def flags(self) -> Any:
+        return self.style[1]
+
+    @property
+    def color(self) -> Any:
+        return self.style[2]
+
+
+class TextLine:
+    __slots__ = ('spans', 'bbox', 'page')
+    type = LineType.TEXT
+
+    def __init__(self, spans: list[Span], bbox: BBox, page: int):
+        self.spans = spans
+        self.bbox = bbox
+        self.page = page
+
+
+class ImageLine:
+    __slots__ = ('bbox', 'page', 'ext', 'width', 'height', 'data')
+    type = LineType.IMAGE
+
+    def __init__(self, bbox: BBox, page: int, ext: str,
+                 width: int, height: int, image: bytes):
+        self.bbox = bbox
+        self.page = page
+        self.ext = ext
+        self.width = width
+        self.height = height
+        # The image's bytes, or a reference to them in a spill file or in
+        # the PDF file; `ext` of the latter is None until it's read
+        self.data = image
+
+    @property
+    def image(self) -> bytes:
+        data = self.data
+        if isinstance(data, bytes):
+            return data
+        image = data.load()
+        if self.ext is None:
+            self.ext = data.ext
+        return image
+
+    @image.setter
+    def image(self, image: bytes) -> None:
+        self.data = image
+
+
+Line: TypeAlias = TextLine | ImageLine
+
+
+def make_line(data: JsonLike, t: LineType, page: int) -> Line:
+    """Make a line from a line (for text) or a block (for images) of
+    PyMuPDF's `dict` output."""
+
+    bbox = tuple(map(float, data['bbox']))
+    if t == LineType.TEXT:
+        spans = [Span(span['text'],
+                      tuple(map(float, span['bbox'])),
+                      intern_style((span['size'],
+                                    span['flags'],
+                                    span['color'])))
+                 for span in data['spans']]
+        return TextLine(spans, bbox, page)
+    return ImageLine(bbox, page, data['ext'],
+                     data['width'], data['height'], data['image'])
 
 
 def line_type(line: Line) -> LineType:
     """Text line or image line."""
 
-    assert '_type' in line and isinstance(line['_type'], LineType)
-    return line['_type']
+    return line.type
@@ -0,0 +1,54 @@
+import os
+import tempfile
+
+
+class SpilledBytes:
+    """Bytes moved out of memory into a spill file, read back on demand."""
+
+    __slots__ = ('fd', 'offset', 'size')
+
+    def __init__(self, fd: int, offset: int, size: int):
+        self.fd = fd
+        self.offset = offset
+        self.size = size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def load(self) -> bytes:
+        return os.pread(self.fd, self.size, self.offset)
+
+
+class SpillFile:
+    """An anonymous temporary file that large payloads are appended to, so
+    that only a small reference to them stays in memory.
+
+    The file is removed when closed; spilled bytes can't be read after
+    that."""
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+
+    def store(self, data: bytes) -> SpilledBytes:
+        fd = self.file.fileno()
+        os.pwrite(fd, data, self.size)
+        spilled = SpilledBytes(fd, self.size, len(data))
+        self.size += len(data)
+        return spilled
+
+    def clear(self) -> None:
+        """Drop everything stored so far; bytes spilled before can't be read
+        after that."""
+
+        self.file.truncate(0)
+        self.size = 0
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> 'SpillFile':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()